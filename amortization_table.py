@@ -10,11 +10,252 @@ amortization_table.py
 # https://github.com/jbmohler/mortgage/blob/master/mortgage.py
 """
 import argparse
+import collections
 import decimal
+import itertools
+import math
 import os
-import pandas as pd
-import numpy as np
+import sys
+import threading
 import datetime as dt
+import financial as fin
+import profiling
+from lazy import lazy_import
+
+# NumPy and pandas load on first use, so a single-loan summary starts fast
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+SCHEDULE_COLUMNS = ['Beg. Balance', 'Monthly Payment', 'Additional Payment',
+                    'Interest', 'Principal', 'End Balance']
+_MONTH_FRACTION = float(decimal.Decimal(1) / 12)
+SCHEDULE_MODES = ('decimal', 'cents', 'numpy')
+SCHEDULE_CACHE_SIZE = int(os.environ.get('MORTGAGE_SCHEDULE_CACHE', 512))
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y')
+
+
+def parse_date(value):
+    """Returns a date from a date, datetime or string in one of DATE_FORMATS"""
+    if isinstance(value, dt.datetime):
+        return value.date()
+    if isinstance(value, dt.date):
+        return value
+    for date_format in DATE_FORMATS:
+        try:
+            return dt.datetime.strptime(str(value), date_format).date()
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized date: ' + repr(value))
+
+
+def next_month_start(today=None):
+    """Returns the first day of the month after today"""
+    today = today or dt.date.today()
+    return dt.date(today.year + today.month // 12, today.month % 12 + 1, 1)
+
+
+def ceil_cents(f):
+    """Returns the float rounded up to whole cents, as an int number of cents
+
+    Matches Mortgage.dollar(f): a float just above a whole cent is compared
+    with the double nearest that cent, exactly as its decimal string would be.
+    """
+    cents = round(f * 100)
+    return cents + (f > cents / 100)
+
+
+def half_up_cents(f):
+    """Returns the float rounded half up to whole cents, as an int number of cents"""
+    if f < 0:
+        return -half_up_cents(-f)
+    cents = math.floor(f * 100)
+    return cents + (f >= (cents + 0.5) / 100)
+
+
+def quantize_array(values, places=2, rounding=decimal.ROUND_CEILING):
+    """Rounds each float exactly as Decimal(str(f)).quantize would
+
+    Supports ROUND_CEILING, ROUND_HALF_UP and ROUND_HALF_EVEN. Every value is
+    compared with the double nearest to its rounding boundary, which gives the
+    same answer as the Decimal round trip without creating any Decimals.
+    """
+    values = np.asarray(values, dtype=float)
+    scale = 10.0 ** places
+    if rounding == decimal.ROUND_CEILING:
+        units = np.rint(values * scale)
+        units += values > units / scale
+        return units / scale
+    magnitude = np.abs(values)
+    units = np.floor(magnitude * scale)
+    half = (units + 0.5) / scale
+    tie = magnitude == half
+    if rounding == decimal.ROUND_HALF_UP:
+        units += (magnitude > half) | tie
+    elif rounding == decimal.ROUND_HALF_EVEN:
+        units += (magnitude > half) | (tie & (units % 2 == 1))
+    else:
+        raise ValueError('Unsupported rounding mode: ' + str(rounding))
+    return np.copysign(units, values) / scale
+
+
+def _settle_schedule(balance, payment, additional, rate, horizon):
+    """Iterates the schedule recurrence over `horizon` months to its fixed point
+
+    Each month's interest only depends on the months before it, so every pass
+    settles at least one more month; in practice the rounding settles within a
+    handful of passes. Returns the beginning balances, the rounded interest and
+    the index of each loan's last payment (-1 if it runs past the horizon).
+    """
+    loans = balance.shape[0]
+    months = np.arange(horizon)
+    growth = 1.0 + rate * _MONTH_FRACTION
+    factor = growth[:, None] ** months
+    with np.errstate(divide='ignore', invalid='ignore'):
+        annuity = np.where(growth[:, None] > 1.0, (factor - 1.0) / (growth[:, None] - 1.0), months)
+    # unrounded closed-form balances are the first guess
+    begin = balance[:, None] * factor - (payment + additional)[:, None] * annuity
+    interest = np.empty_like(begin)
+    final = np.full(loans, -1)
+    steps = np.empty((loans, horizon + 1))
+    steps[:, 0] = balance
+    active = np.arange(loans)
+    # every pass settles at least one more month, so horizon + 1 passes settle them all
+    for _ in range(horizon + 1):
+        if not active.size:
+            break
+        guess = begin[active]
+        owed = quantize_array(guess * rate[active, None] * _MONTH_FRACTION, rounding=decimal.ROUND_HALF_UP)
+        principal = quantize_array(payment[active, None] - owed)
+        steps[active, 1:] = principal + additional[active, None]
+        settled = np.subtract.accumulate(steps[active], axis=1)[:, :-1]
+        done = (payment + additional)[active, None] >= guess + owed
+        last = np.where(done.any(axis=1), done.argmax(axis=1), horizon - 1)
+        stable = ((settled == guess) | (months > last[:, None])).all(axis=1)
+        interest[active] = owed
+        final[active[stable]] = np.where(done[stable].any(axis=1), last[stable], -1)
+        begin[active] = settled
+        active = active[~stable]
+    else:
+        if active.size:
+            raise ValueError('Schedule did not settle for loans at rows {0}'.format(active.tolist()))
+    return begin, interest, final
+
+
+@profiling.timed('schedule.columns', rows=lambda result: result[0].sum())
+def schedule_columns(amount, rate, term, additional=0, payment=None):
+    """Returns the amortization schedules of one or more loans as NumPy columns
+
+    Reproduces Mortgage.monthly_payment_schedule to the cent with a few array
+    operations per pass instead of a Decimal round trip per value.
+
+    Args:
+        amount, rate, term, additional: scalars or equal-length arrays with
+            the same meaning as the Mortgage arguments
+        payment: monthly payment before rounding; uses the Mortgage formula
+            when not given
+
+    Returns:
+        (lengths, columns): the number of payments on each loan and a tuple of
+        flat arrays ordered like SCHEDULE_COLUMNS, one loan after another
+    """
+    amount, rate, term, additional = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(amount, dtype=float)), np.asarray(rate, dtype=float),
+        np.asarray(term, dtype=float), np.asarray(additional, dtype=float))
+    if payment is None:
+        payment = -fin.pmt(rate / 12, term * 12, amount)
+    payment = np.broadcast_to(np.asarray(payment, dtype=float), amount.shape)
+    # a NaN never settles, e.g. a blank additional cell in a loan file
+    bad = ~(np.isfinite(amount) & np.isfinite(rate) & np.isfinite(term) & np.isfinite(additional)
+            & np.isfinite(payment))
+    if bad.any():
+        raise ValueError('Loans at rows {0} have a missing or infinite amount, rate, term, additional or '
+                         'payment'.format(np.flatnonzero(bad).tolist()))
+    term = term.astype(int)
+    payment = quantize_array(payment)
+    additional = quantize_array(additional)
+    balance = quantize_array(amount)
+    rate = quantize_array(rate, places=6, rounding=decimal.ROUND_HALF_EVEN)
+
+    horizon = int(term.max()) * 12 + 1
+    while True:
+        begin, interest, final = _settle_schedule(balance, payment, additional, rate, horizon)
+        if (final >= 0).all():
+            break
+        if horizon > int(term.max()) * 96:
+            raise ValueError('Payments do not pay off the loan')
+        horizon *= 2
+
+    loans = np.arange(amount.shape[0])
+    principal = quantize_array(payment[:, None] - interest)
+    extra = np.broadcast_to(additional[:, None], begin.shape).copy()
+    paid = np.broadcast_to(payment[:, None], begin.shape).copy()
+    end = begin - (principal + extra)
+
+    # final payment: either the scheduled payment covers the balance or the
+    # additional payment is cut down to what remains
+    last_begin = begin[loans, final]
+    last_interest = interest[loans, final]
+    covered = payment >= last_begin + last_interest
+    last_extra = np.where(covered, 0.0, (last_begin + last_interest) - payment)
+    last_principal = np.where(covered, quantize_array(last_begin), principal[loans, final])
+    principal[loans, final] = last_principal
+    extra[loans, final] = last_extra
+    paid[loans, final] = quantize_array(last_principal + last_interest)
+    end[loans, final] = last_begin - quantize_array(last_principal + last_extra)
+
+    rows = np.arange(begin.shape[1]) <= final[:, None]
+    columns = (quantize_array(begin[rows]), paid[rows], extra[rows],
+               interest[rows], principal[rows], quantize_array(end[rows]))
+    return final + 1, columns
+
+
+class ScheduleCache:
+    """Size-bounded LRU cache of computed schedules and tables
+
+    Entries are keyed on the loan terms, so Mortgage objects with the same
+    amount, rate, term, additional payment and inflation share one schedule.
+    Safe to use from several threads.
+
+        Args:
+            maxsize (int): entries kept before the least recently used is
+                dropped; 0 disables the cache
+    """
+    def __init__(self, maxsize=SCHEDULE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Returns the cached value for key, calling compute() on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = compute()
+        if self.maxsize > 0:
+            with self._lock:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Drops every entry and resets the hit counts"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+SCHEDULE_CACHE = ScheduleCache()
+
 
 class Mortgage:
     """Contains properties of a mortgage given user inputs
@@ -26,10 +267,28 @@ class Mortgage:
             _taxes (float): Annual tax bill
             _insurance (float): Annual insurance bill
             _additional (float): Extra payment in each month that goes toward principal
-            
+            _schedule_mode (str): Engine behind monthly_payment_schedule, one of
+                'decimal' (reference), 'cents' or 'numpy'
+            _first_payment (date): Date of the first payment; a date or a
+                string in one of DATE_FORMATS, defaulting to the first of next month
+
+        Derived values are computed once and kept until one of the inputs is
+        assigned again. Schedules and tables are shared through SCHEDULE_CACHE.
     """
-    def __init__(self, amount, price, rate, term, taxes, insurance, additional=0):
+    __slots__ = ('_derived', '_amount', '_price', '_rate', '_term', '_taxes', '_insurance', '_add_pmt',
+                 '_total_combined_payments', '_payment_months', '_inflation', '_pv_payments',
+                 '_pv_combined_payments', '_first_payment', '_pay_freq', '_compound_freq', '_pay_type',
+                 '_schedule_mode')
+    _INPUTS = frozenset(['_amount', '_price', '_rate', '_term', '_taxes', '_insurance', '_add_pmt', '_inflation'])
+    MONTHS_IN_YEAR = 12
+    DOLLAR_QUANTIZE = decimal.Decimal('.01')
+
+    def __init__(self, amount, price, rate, term, taxes, insurance, additional=0, schedule_mode='decimal',
+                 first_payment=None):
         """init function for Mortgage class"""
+        if schedule_mode not in SCHEDULE_MODES:
+            raise ValueError('Unknown schedule mode: ' + str(schedule_mode))
+        self._derived = {}
         self._amount = amount
         self._price = price
         self._rate = rate
@@ -42,13 +301,28 @@ class Mortgage:
         self._inflation = float(0.03)
         self._pv_payments = float(0)
         self._pv_combined_payments = float(0)
-        self._first_payment = '1/1/2018' # future update
+        self._first_payment = parse_date(first_payment) if first_payment else next_month_start()
         self._pay_freq = 'Monthly' # only option for now
         self._compound_freq = 'Monthly' # only option for now
         self._pay_type = 'End of Period' # only option for now
-        self.MONTHS_IN_YEAR = 12
-        self.DOLLAR_QUANTIZE = decimal.Decimal('.01')
+        self._schedule_mode = schedule_mode
 
+    def __setattr__(self, name, value):
+        if name in Mortgage._INPUTS:
+            self._derived.clear()
+        object.__setattr__(self, name, value)
+
+    def _memo(self, name, compute):
+        """Returns a derived value, computing it only once per set of inputs"""
+        try:
+            return self._derived[name]
+        except KeyError:
+            value = self._derived[name] = compute()
+            return value
+
+    def _schedule_key(self):
+        """Returns the loan terms that identify the schedule in SCHEDULE_CACHE"""
+        return self._amount, self._rate, self._term, self._add_pmt, self._inflation
 
     def dollar(self, f, round=decimal.ROUND_CEILING):
         """Returns the passed float rounded to two decimal places"""
@@ -72,6 +346,10 @@ class Mortgage:
         """Returns the term, in months, of the loan"""
         return self._term * self.MONTHS_IN_YEAR
 
+    def first_payment(self):
+        """Returns the date of the first payment"""
+        return self._first_payment
+
     def price(self):
         """Returns the house price"""
         return self._price
@@ -102,22 +380,30 @@ class Mortgage:
     
     def monthly_payment(self):
         """Returns the monthly payment for the loan"""
-        pmt = (self.amount() * self.rate()) / (self.MONTHS_IN_YEAR * (1.0-(1.0/self.monthly_growth()) ** self.loan_months()))
-        return pmt
+        return self._memo('monthly_payment', lambda: -fin.pmt(self.rate() / self.MONTHS_IN_YEAR,
+                                                               self.loan_months(), self.amount()))
 
     def annual_payment(self):
         """Returns the total payments during the year for the loan"""
-        return self.monthly_payment() * self.MONTHS_IN_YEAR
+        return self._memo('annual_payment', lambda: self.monthly_payment() * self.MONTHS_IN_YEAR)
 
     def total_payment(self):
         """Returns the total cost of the loan"""
-        return self.monthly_payment() * self.loan_months()
+        return self._memo('total_payment', lambda: self.monthly_payment() * self.loan_months())
 
     def piti(self):
         """Returns the monthly PITI"""
-        return self.monthly_payment() + self.monthly_taxes() + self.monthly_insurance()
+        return self._memo('piti', lambda: self.monthly_payment() + self.monthly_taxes() + self.monthly_insurance())
 
     def monthly_payment_schedule(self):
+        """Returns an iterator over the amortization schedule, using the schedule mode"""
+        if self._schedule_mode == 'cents':
+            return self.cents_payment_schedule()
+        if self._schedule_mode == 'numpy':
+            return zip(*self.schedule_arrays())
+        return self.decimal_payment_schedule()
+
+    def decimal_payment_schedule(self):
         """Yields amortization schedule for the given loan"""
         monthly = float(self.dollar(self.monthly_payment()))
         additional = float(self.dollar(self.additional_pmt()))
@@ -147,6 +433,101 @@ class Mortgage:
             yield float(self.dollar(balance)), monthly, additional, interest, principal, float(self.dollar(end_balance))
             balance = end_balance
 
+    def cents_payment_schedule(self):
+        """Yields the same schedule as decimal_payment_schedule without Decimals
+
+        Payments, interest and principal are rounded in integer cents. The
+        balance stays the running float the reference keeps, since its rounded
+        figures depend on that float's drift.
+        """
+        for row, _ in self._cents_rows():
+            yield row
+
+    def _cents_rows(self, balance=None):
+        """Yields each cents schedule row with the running float balance after it
+
+        Starts from the given running balance instead of the loan amount, to
+        continue a schedule from a ScheduleView checkpoint.
+        """
+        monthly = ceil_cents(self.monthly_payment()) / 100
+        additional = ceil_cents(self.additional_pmt()) / 100
+        if balance is None:
+            balance = ceil_cents(self.amount()) / 100
+        end_balance = balance
+        rate = float(decimal.Decimal(str(self.rate())).quantize(decimal.Decimal('.000001')))
+        while True:
+            interest = half_up_cents(balance * rate * _MONTH_FRACTION) / 100
+
+            if monthly >= balance + interest:  # last pmt
+                principal = ceil_cents(end_balance) / 100
+                end_balance -= principal
+                yield (ceil_cents(balance) / 100, ceil_cents(principal + interest) / 100, 0.0, interest, principal, ceil_cents(end_balance) / 100), end_balance
+                break
+
+            # the float difference can land just above the cent, which rounds up
+            principal = ceil_cents(monthly - interest) / 100
+            if (monthly + additional) >= balance + interest:
+                additional = (balance + interest) - monthly
+                end_balance -= ceil_cents(principal + additional) / 100
+                yield (ceil_cents(balance) / 100, ceil_cents(principal + interest) / 100, additional, interest, principal, ceil_cents(end_balance) / 100), end_balance
+                break
+
+            end_balance -= (principal + additional)
+            yield (ceil_cents(balance) / 100, monthly, additional, interest, principal, ceil_cents(end_balance) / 100), end_balance
+            balance = end_balance
+
+    def schedule_view(self, checkpoint=None):
+        """Returns a ScheduleView that generates rows only as far as they are asked for"""
+        return ScheduleView(self, checkpoint)
+
+    def schedule_arrays(self):
+        """Returns the amortization schedule as a tuple of NumPy columns"""
+        _, columns = schedule_columns(self.amount(), self.rate(), self.loan_years(),
+                                      self.additional_pmt(), payment=self.monthly_payment())
+        return columns
+
+    def _payoff_terms(self, additional):
+        """Returns the monthly rate and the total monthly payment"""
+        if additional is None:
+            additional = self.additional_pmt()
+        return self.rate() / self.MONTHS_IN_YEAR, self.monthly_payment() + additional
+
+    def balance_after(self, months, additional=None):
+        """Returns the balance left after the given number of payments, before cent rounding"""
+        rate, payment = self._payoff_terms(additional)
+        return max(-fin.fv(rate, months, -payment, self.amount()), 0.0)
+
+    def payoff_months(self, additional=None):
+        """Returns the number of payments until the loan is paid off"""
+        rate, payment = self._payoff_terms(additional)
+        months = fin.nper(rate, -payment, self.amount())
+        # the tolerance keeps float noise from adding a month to an exact term
+        return min(math.ceil(months - 1e-9), self.loan_months())
+
+    def total_interest(self, additional=None):
+        """Returns the interest paid over the life of the loan"""
+        rate, payment = self._payoff_terms(additional)
+        months = self.payoff_months(additional)
+        last = self.balance_after(months - 1, additional) * (1.0 + rate)
+        return payment * (months - 1) + last - self.amount()
+
+    def interest_saved(self, additional=None):
+        """Returns the interest saved by paying the additional amount each month"""
+        return self.total_interest(0) - self.total_interest(additional)
+
+    def additional_for_payoff(self, years):
+        """Returns the additional monthly payment that pays the loan off in the given years"""
+        payment = -fin.pmt(self.rate() / self.MONTHS_IN_YEAR, years * self.MONTHS_IN_YEAR, self.amount())
+        return max(payment - self.monthly_payment(), 0.0)
+
+    def annual_rollup(self):
+        """Returns the loan's interest, principal, tax and insurance totals per calendar year"""
+        import rollups
+        loan = pd.DataFrame({'amount': [self.amount()], 'price': [self.price()], 'rate': [self.rate()],
+                             'term': [self.loan_years()], 'taxes': [self.taxes()], 'insurance': [self._insurance],
+                             'additional': [self.additional_pmt()]})
+        return rollups.rollup_chunk(loan, self.first_payment()).drop(columns='loan_id').set_index('year')
+
     def print_monthly_payment_schedule(self):
         """Prints out the monthly payment schedule"""
         for index, payment in enumerate(self.monthly_payment_schedule()):
@@ -159,55 +540,115 @@ class Mortgage:
             amort_dict[index + 1] = [payment[0], payment[1], payment[2], payment[3], payment[4], payment[5]]
         return amort_dict
 
-    def amortization_table(self):
-        """Returns a dataframe with the amortization table in it"""
-        names = ['Beg. Balance', 'Monthly Payment', 'Additional Payment',
-                 'Interest', 'Principal', 'End Balance']
-        df = pd.DataFrame.from_dict(self.amortization_dict(), orient='index')
-        df.columns = names
+    def schedule_table_columns(self):
+        """Returns the amortization schedule as NumPy columns from the schedule mode
+
+        The columns come from SCHEDULE_CACHE and are read-only.
+        """
+        return SCHEDULE_CACHE.get(('columns',) + self._schedule_key(), self._schedule_table_columns)
+
+    def _schedule_table_columns(self):
+        """Computes the schedule columns with the schedule mode"""
+        with profiling.stage('schedule.' + self._schedule_mode) as stage:
+            if self._schedule_mode == 'numpy':
+                columns = self.schedule_arrays()
+            else:
+                columns = tuple(np.array(column) for column in zip(*self.monthly_payment_schedule()))
+            stage.rows = len(columns[0])
+        for column in columns:
+            column.flags.writeable = False
+        return columns
+
+    def compact_schedule(self):
+        """Returns the amortization schedule as a CompactSchedule of int64 cents"""
+        import compact_schedule
+        columns = self.schedule_table_columns()
+        return compact_schedule.CompactSchedule.from_columns([len(columns[0])], columns)
+
+    @profiling.timed('table.present_values')
+    def _present_values(self, columns):
+        """Returns the PV table columns and the summary figures of a schedule"""
+        payment_months = len(columns[0])
         monthly_inflation = self._inflation / 12
-        if sum(df['Additional Payment'].values) != 0: #check if there are additional payments
-            df['Total Payment'] = df['Monthly Payment'] + df['Additional Payment']
-            self._total_combined_payments = sum(df['Total Payment'].values)
-            self._payment_months = df.shape[0]
-            # calc PV of original terms
-            arr_months = np.array(range(self.loan_years() * 12))
-            arr_m_payment = np.array(self.monthly_payment())
-            list_inflation = []
-            for month in arr_months:
-                list_inflation.append((1 + monthly_inflation) ** month)
-            arr_inflation = np.array(list_inflation)
-            arr_pv_payments = np.divide(arr_m_payment, arr_inflation)
-            self._pv_payments = sum(arr_pv_payments)
-
-            # add combined PV factor
-            arr_c_months = np.array(range(self._payment_months))
-            list_c_inflation = []
-            for month in arr_c_months:
-                list_c_inflation.append((1 + monthly_inflation) ** month)
-            arr_c_inflation = np.array(list_c_inflation)
-            df['PV of Combined Payment'] = (df['Monthly Payment'] + df['Additional Payment']) / arr_c_inflation
-            self._pv_combined_payments = sum(df['PV of Combined Payment'].values)
-            return df
+        # one discount factor per month, covering both the original and the actual term
+        discount = (1 + monthly_inflation) ** np.arange(max(payment_months, self.loan_months()))
+        figures = {'total_combined_payments': float(0), 'payment_months': float(0),
+                   'pv_payments': float(0), 'pv_combined_payments': float(0)}
+        if columns[2].sum() != 0: #check if there are additional payments
+            total = columns[1] + columns[2]
+            pv_total = total / discount[:payment_months]
+            table = {'Total Payment': total, 'PV of Combined Payment': pv_total}
+            figures['total_combined_payments'] = total.sum()
+            figures['payment_months'] = payment_months
+            # PV of original terms
+            figures['pv_payments'] = (self.monthly_payment() / discount[:self.loan_months()]).sum()
+            figures['pv_combined_payments'] = pv_total.sum()
         else:
-            # add PV factor
-            arr_months = np.array(range(self.loan_months()))
-            list_inflation = []
-            for month in arr_months:
-                list_inflation.append((1 + monthly_inflation) ** month)
-            arr_inflation = np.array(list_inflation)
-            df['PV of Payment'] = df['Monthly Payment'] / arr_inflation
-            self._pv_payments = sum(df['PV of Payment'].values)
-            return df
-
-    def amort_table_to_csv(self):
-        """Outputs the amortization table to a .csv file"""
-        now = dt.datetime.today()
-        date = str(now.year) + str(now.month) + str(now.day) + '_' + str(now.hour) + str(now.minute)
-        self.amortization_table().to_csv('/home/david/git_repos/mortgage/output/' + date + '.csv')
+            pv = columns[1] / discount[:payment_months]
+            table = {'PV of Payment': pv}
+            figures['pv_payments'] = pv.sum()
+        return table, figures
+
+    def _apply_figures(self, figures):
+        """Stores the summary figures on the attributes print_summary reads"""
+        self._total_combined_payments = figures['total_combined_payments']
+        self._payment_months = figures['payment_months']
+        self._pv_payments = figures['pv_payments']
+        self._pv_combined_payments = figures['pv_combined_payments']
+        return figures
+
+    def _schedule_figures(self):
+        """Computes the summary figures of _present_values in plain Python, without NumPy"""
+        if self._schedule_mode == 'numpy':
+            return self._present_values(self.schedule_table_columns())[1]
+        with profiling.stage('schedule.' + self._schedule_mode) as stage:
+            rows = list(self.monthly_payment_schedule())
+            stage.rows = len(rows)
+        with profiling.stage('table.present_values', rows=len(rows)):
+            growth = 1 + self._inflation / 12
+            figures = {'total_combined_payments': float(0), 'payment_months': float(0),
+                       'pv_payments': float(0), 'pv_combined_payments': float(0)}
+            if any(row[2] for row in rows): #check if there are additional payments
+                totals = [row[1] + row[2] for row in rows]
+                monthly = self.monthly_payment()
+                figures['total_combined_payments'] = math.fsum(totals)
+                figures['payment_months'] = len(rows)
+                # PV of original terms
+                figures['pv_payments'] = math.fsum(monthly / growth ** m for m in range(int(self.loan_months())))
+                figures['pv_combined_payments'] = math.fsum(t / growth ** m for m, t in enumerate(totals))
+            else:
+                figures['pv_payments'] = math.fsum(row[1] / growth ** m for m, row in enumerate(rows))
+        return figures
+
+    def schedule_figures(self):
+        """Returns the total and PV figures of the schedule without building the table"""
+        figures = SCHEDULE_CACHE.get(('figures',) + self._schedule_key(), self._schedule_figures)
+        return self._apply_figures(figures)
+
+    def _amortization_table(self):
+        """Builds the amortization table and its summary figures"""
+        columns = self.schedule_table_columns()
+        table, figures = self._present_values(columns)
+        with profiling.stage('table.frame', rows=len(columns[0])):
+            df = pd.DataFrame(dict(zip(SCHEDULE_COLUMNS, columns)), index=np.arange(1, len(columns[0]) + 1))
+            for name, column in table.items():
+                df[name] = column
+        return df, figures
+
+    def amortization_table(self):
+        """Returns a dataframe with the amortization table in it"""
+        df, figures = SCHEDULE_CACHE.get(('table',) + self._schedule_key(), self._amortization_table)
+        self._apply_figures(figures)
+        return df.copy()
+
+    def amort_table_to_csv(self, sink):
+        """Writes the amortization schedule to a .csv (or .parquet) path or a text file"""
+        import schedule_export
+        return schedule_export.export_schedules([self], sink)
 
     def print_summary(self):
         """Prints out a summary of the given mortgage"""
+        self.schedule_figures()
         print('Mortgage Summary')
         print('-' * 75)
         print('{0:>30s}: ${1:>11,.0f}'.format('House Price', self.price()))
@@ -249,14 +690,174 @@ class Mortgage:
         # re-reference totals to include additional payments (new function needed)
         # pv of payments
 
-    def main(self, csv=False):
-        """Generates an amortization table and prints the summary"""
-        self.amortization_table() # print [0] for the table # need to run to get summary stats
-        if csv == True:
-            self.amort_table_to_csv() #optional, use if want to export
+    def main(self, csv=None):
+        """Prints the summary, first exporting the schedule to the csv path if one is given"""
+        if csv:
+            self.amort_table_to_csv(csv) #optional, use if want to export
         self.print_summary()
 
 
+class ScheduleView:
+    """Indexable amortization schedule of one Mortgage, generated on demand
+
+    Rows are the monthly_payment_schedule tuples, indexed from 0 for the
+    first month like a list, so view[132:144] is the twelfth year. The cents
+    engine runs only as far as the furthest month asked for and the rows
+    are kept, so a later window continues where the last one stopped. Every
+    figure matches the full schedule to the cent.
+
+    The month-by-month rounding has no exact closed form. A servicing
+    system can store checkpoint(n) with the loan and open the next window
+    from it, generating only that window's rows. For estimates without any
+    rows, use Mortgage.balance_after and total_interest.
+
+        Args:
+            mortgage (Mortgage): the loan
+            checkpoint (tuple): (months, balance) from checkpoint(); the
+                view starts after that many payments, and earlier months
+                cannot be read
+    """
+    __slots__ = ('_first', '_start', '_rows', '_balances', '_source', '_done')
+
+    def __init__(self, mortgage, checkpoint=None):
+        months, balance = checkpoint or (0, None)
+        self._first = months
+        # running balance the first row starts from, as _cents_rows takes it
+        self._start = ceil_cents(mortgage.amount()) / 100 if balance is None else balance
+        self._rows = []
+        self._balances = []
+        self._source = mortgage._cents_rows(balance)
+        self._done = False
+
+    def _fill(self, stop=None):
+        """Generates rows up to month stop (all of them if None) or until the loan is paid off"""
+        need = None if stop is None else stop - self._first - len(self._rows)
+        if self._done or (need is not None and need <= 0):
+            return
+        for row, balance in itertools.islice(self._source, need):
+            self._rows.append(row)
+            self._balances.append(balance)
+        if need is None or stop - self._first > len(self._rows):
+            self._done = True
+
+    def __len__(self):
+        """Returns the number of payments, generating the rest of the schedule"""
+        self._fill()
+        return self._first + len(self._rows)
+
+    def __iter__(self):
+        return iter(self[self._first:])
+
+    def _position(self, month):
+        """Returns the index into the kept rows of a month from 0"""
+        if month < self._first:
+            raise IndexError('month {0} is before the checkpoint at {1}'.format(month, self._first))
+        return month - self._first
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if (key.start is not None and key.start < 0) or key.stop is None or key.stop < 0:
+                start, stop, step = key.indices(len(self))
+            else:
+                start, stop, step = key.start or 0, key.stop, key.step or 1
+                self._fill(stop)
+            if step != 1:
+                raise ValueError('schedule slices must be contiguous')
+            if start >= stop:
+                return []
+            return self._rows[self._position(start):max(stop - self._first, 0)]
+        if key < 0:
+            key += len(self)
+        self._fill(key + 1)
+        position = self._position(key)
+        if position >= len(self._rows):
+            raise IndexError('schedule index out of range')
+        return self._rows[position]
+
+    def balance(self, months):
+        """Returns the balance after the given number of payments"""
+        if months == self._first:
+            return self[months][0]
+        self._fill(months)
+        position = self._position(months)
+        return self._rows[position - 1][5] if position <= len(self._rows) else 0.0
+
+    def checkpoint(self, months):
+        """Returns the exact state after the given number of payments, to open a later view from
+
+        There must be a payment left after them.
+        """
+        self._fill(months + 1)
+        position = self._position(months)
+        if position >= len(self._rows):
+            raise IndexError('the loan is paid off after {0} payments'.format(self._first + len(self._rows)))
+        if position == 0:
+            return months, self._start
+        return months, self._balances[position - 1]
+
+    def interest(self, start=None, stop=None):
+        """Returns the interest paid in the months start (the view's first by default) to stop, as a slice"""
+        return math.fsum(row[3] for row in self[self._first if start is None else start:stop])
+
+    def principal(self, start=None, stop=None):
+        """Returns the scheduled principal paid in the months start to stop, as a slice"""
+        return math.fsum(row[4] for row in self[self._first if start is None else start:stop])
+
+    def payments(self, start=None, stop=None):
+        """Returns the total paid, with additional payments, in the months start to stop, as a slice"""
+        return math.fsum(row[1] + row[2] for row in self[self._first if start is None else start:stop])
+
+
+def test():
+    """Checks every schedule mode against the decimal_payment_schedule reference"""
+    import portfolio
+    loans = portfolio.SAMPLE_LOANS + [(200000, 250000, 0.05, 30, 7000, 0.0035, 100),
+                                      (1000000, 1250000, 0.0275, 30, 25000, 0.0035, 25000)]
+    for loan in loans:
+        reference = list(Mortgage(*loan).decimal_payment_schedule())
+        for mode in SCHEDULE_MODES:
+            assert list(Mortgage(*loan, schedule_mode=mode).monthly_payment_schedule()) == reference, (loan, mode)
+        # closed-form figures agree with the rounded schedule to within a month / 0.01%
+        m = Mortgage(*loan)
+        assert abs(m.payoff_months() - len(reference)) <= 1, loan
+        assert math.isclose(m.total_interest(), sum(row[3] for row in reference), rel_tol=1e-4), loan
+        assert math.isclose(m.balance_after(12), reference[11][5], rel_tol=1e-4), loan
+        # windows and sums of the on-demand view, and a view reopened from a checkpoint
+        view = m.schedule_view()
+        assert view[132:144] == reference[132:144] and view[5] == reference[5], loan
+        assert view.interest(12, 24) == math.fsum(row[3] for row in reference[12:24]), loan
+        months = min(60, len(reference) - 1)
+        assert view.balance(months) == reference[months - 1][5] and view.balance(0) == reference[0][0], loan
+        resumed = m.schedule_view(view.checkpoint(months))
+        assert resumed[months:] == reference[months:] and len(resumed) == len(view) == len(reference), loan
+        # a checkpoint at a view's own first month keeps the running balance
+        again = m.schedule_view(m.schedule_view(resumed.checkpoint(months)).checkpoint(months))
+        assert list(again) == reference[months:], loan
+        assert resumed.interest() == math.fsum(row[3] for row in reference[months:]), loan
+        # empty windows before the checkpoint are empty, as with a list
+        assert resumed[10:5] == resumed[20:20] == [] and resumed.interest(0, 0) == 0, loan
+        assert view[-1] == reference[-1] and list(view) == reference, loan
+        if m.loan_years() > 10:
+            payoff = Mortgage(*loan[:6], m.additional_for_payoff(10), schedule_mode='cents')
+            assert abs(len(list(payoff.monthly_payment_schedule())) - 120) <= 1, loan
+    # derived values follow the inputs, and equal loans share one cached table
+    m = Mortgage(*loans[1])
+    payment = m.monthly_payment()
+    m._rate = 0.06
+    assert m.monthly_payment() > payment
+    SCHEDULE_CACHE.clear()
+    table = Mortgage(*loans[1], schedule_mode='numpy').amortization_table()
+    assert Mortgage(*loans[1], schedule_mode='cents').amortization_table().equals(table)
+    assert (SCHEDULE_CACHE.hits, SCHEDULE_CACHE.misses) == (1, 2)
+    lengths, columns = schedule_columns([l[0] for l in loans], [l[2] for l in loans],
+                                        [l[3] for l in loans], [l[6] for l in loans])
+    rows = list(zip(*columns))
+    for loan, length in zip(loans, lengths):
+        assert list(Mortgage(*loan).decimal_payment_schedule()) == rows[:length], loan
+        rows = rows[length:]
+    print('schedule parity ok')
+
+
 def main():
     parser = argparse.ArgumentParser(description='Mortgage Tools')
     parser.add_argument('-r', '--interest', default=5, dest='interest')
@@ -266,13 +867,45 @@ def main():
     parser.add_argument('-t', '--taxes', default=7000, dest ='taxes')
     parser.add_argument('-i', '--insurance', default=0.0035, dest='insurance')
     parser.add_argument('-e', '--extra payment', default=None, dest='extra')
+    parser.add_argument('-m', '--schedule-mode', default='decimal', choices=SCHEDULE_MODES, dest='mode')
+    parser.add_argument('-o', '--output', default=None, dest='output',
+                        help='export the schedule(s) to this .csv or .parquet file')
+    parser.add_argument('-f', '--loan-file', default=None, dest='loan_file',
+                        help='CSV or Parquet file of loans whose schedules are exported')
+    parser.add_argument('--chunk-size', default=10000, type=int, dest='chunk_size')
+    parser.add_argument('-b', '--batch', action='store_true', dest='batch',
+                        help='with --loan-file, write each loan\'s summary figures instead of its schedule')
+    parser.add_argument('-w', '--workers', default=None, type=int, dest='workers',
+                        help='worker processes for --batch; defaults to the CPU count')
+    parser.add_argument('--profile', action='store_true', dest='profile',
+                        help='print the time spent in each stage to stderr')
     args = parser.parse_args() 
+    if args.profile:
+        profiling.enable()
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            profiling.report()
+
+
+def run(args):
+    """Runs the command line options parsed by main"""
+    if args.loan_file and args.batch:
+        import batch
+        batch.run_batch(args.loan_file, args.output or sys.stdout, args.workers, args.chunk_size)
+        return
+    if args.loan_file:
+        import schedule_export
+        loans = schedule_export.read_loan_file(args.loan_file, args.chunk_size)
+        schedule_export.export_schedules(loans, args.output or sys.stdout, chunk_size=args.chunk_size)
+        return
 
     if args.extra:
-        m = Mortgage(float(args.amount), float(args.price), float(args.interest) / 100.0, int(args.years), float(args.taxes), float(args.insurance), float(args.extra))
+        m = Mortgage(float(args.amount), float(args.price), float(args.interest) / 100.0, int(args.years), float(args.taxes), float(args.insurance), float(args.extra), schedule_mode=args.mode)
     else:
-        m = Mortgage(float(args.amount), float(args.price), float(args.interest) / 100.0, int(args.years), float(args.taxes), float(args.insurance))
-    m.main()
+        m = Mortgage(float(args.amount), float(args.price), float(args.interest) / 100.0, int(args.years), float(args.taxes), float(args.insurance), schedule_mode=args.mode)
+    m.main(csv=args.output)
     
 if __name__ == '__main__':
     main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+batch.py
+
+Runs the Mortgage summary figures for every loan in a CSV or Parquet loan
+file. The file is read in chunks, the chunks are summarized on a process
+pool sized to the host, and the results are written in order to a single
+CSV or Parquet file.
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import portfolio
+import schedule_export
+
+CHUNK_SIZE = 10000
+
+
+def summarize_chunk(df, inflation=0.03):
+    """Returns the portfolio_summary figures of a chunk of loans as a DataFrame"""
+    summary = pd.DataFrame(portfolio.portfolio_summary(df, inflation=inflation), index=df.index)
+    summary.insert(0, 'loan_id', df['loan_id'].values if 'loan_id' in df else df.index.values)
+    return summary
+
+
+def _summaries(chunks, workers, inflation, progress):
+    """Yields the summaries of the chunks in order, keeping the pool busy
+
+    At most two chunks per worker are in flight, so memory stays bounded
+    whatever the size of the loan file.
+    """
+    start = time.time()
+    done = 0
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(summarize_chunk, chunk, inflation))
+            if len(pending) >= 2 * workers:
+                summary = pending.popleft().result()
+                done += len(summary)
+                if progress:
+                    _report(done, start)
+                yield summary
+        while pending:
+            summary = pending.popleft().result()
+            done += len(summary)
+            if progress:
+                _report(done, start)
+            yield summary
+
+
+def _report(done, start):
+    """Prints the loans processed so far to stderr"""
+    elapsed = time.time() - start
+    print('{0:>12,d} loans  {1:>8.1f}s  {2:>10,.0f} loans/s'.format(done, elapsed, done / max(elapsed, 1e-9)),
+          file=sys.stderr)
+
+
+def run_batch(loan_file, output, workers=None, chunk_size=CHUNK_SIZE, inflation=0.03, progress=True):
+    """Summarizes every loan in loan_file and writes the results to output
+
+    Args:
+        loan_file: CSV or Parquet file with the portfolio.LOAN_COLUMNS columns
+            and optionally a loan_id column
+        output: .csv or .parquet path, or a writable text file for CSV
+        workers (int): worker processes; defaults to the CPU count
+        chunk_size (int): loans per task
+
+    Returns:
+        int: number of loans written
+    """
+    workers = workers or os.cpu_count()
+    chunks = schedule_export.read_loan_file(loan_file, chunk_size)
+    return schedule_export.write_frames(_summaries(chunks, workers, inflation, progress), output)
+
+
+def test():
+    """Checks run_batch on a loan file against the Mortgage figures of each loan"""
+    import tempfile
+    loans = portfolio.sample_loans(loan_id=['a', 'b', 'c'])
+    with tempfile.TemporaryDirectory() as path:
+        loan_file, output = os.path.join(path, 'loans.csv'), os.path.join(path, 'summary.csv')
+        # a blank extra payment is no extra payment
+        loans.assign(additional=loans['additional'].replace(0, np.nan)).to_csv(loan_file, index=False)
+        assert run_batch(loan_file, output, workers=1, chunk_size=2, progress=False) == len(loans)
+        summary = pd.read_csv(output)
+    assert list(summary['loan_id']) == list(loans['loan_id'])
+    for m, row in zip(portfolio.mortgages(loans), summary.itertuples(index=False)):
+        m.amortization_table()
+        assert np.isclose(row.monthly_payment, m.monthly_payment()), row.loan_id
+        assert np.isclose(row.piti, m.piti()), row.loan_id
+        assert np.isclose(row.total_payment, m.total_payment()), row.loan_id
+        assert np.isclose(row.pv_payment, m._pv_payments), row.loan_id
+        if m.additional_pmt():
+            assert np.isclose(row.total_combined_payment, m._total_combined_payments), row.loan_id
+            assert np.isclose(row.pv_combined_payment, m._pv_combined_payments), row.loan_id
+        else:
+            assert row.change_total_payment == 0 and np.isnan(row.new_piti), row.loan_id
+    print('batch ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize a file of loans')
+    parser.add_argument('loan_file', help='CSV or Parquet file of loans')
+    parser.add_argument('-o', '--output', default=None, dest='output',
+                        help='.csv or .parquet file for the results; CSV to stdout if omitted')
+    parser.add_argument('-w', '--workers', default=None, type=int, dest='workers')
+    parser.add_argument('--chunk-size', default=CHUNK_SIZE, type=int, dest='chunk_size')
+    parser.add_argument('-q', '--quiet', action='store_true', dest='quiet')
+    args = parser.parse_args()
+    run_batch(args.loan_file, args.output or sys.stdout, args.workers, args.chunk_size,
+              progress=not args.quiet)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks.py
+
+Benchmark suite for the hot paths: schedules, amortization tables, portfolio
+figures, sensitivity grids, refinance offers, tax lookups, affordability,
+rate fetching and the rate history. Loans come from fixed, seeded fixtures
+(a single loan, 1k and 1M loans, 15/30/40 year terms, with and without extra
+payments) and the tax benchmarks read the offline tables in fixtures/taxes.
+
+Results can be saved as a JSON baseline; a later run compared against it
+exits with status 1 when a benchmark is slower than the baseline by more
+than the threshold.
+
+    python benchmarks.py --save                 # record benchmark_baseline.json
+    python benchmarks.py --compare              # fail on a regression
+    python benchmarks.py --only schedule table  # run some groups
+"""
+import argparse
+import collections
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import types
+import numpy as np
+import pandas as pd
+import amortization_table as amort
+import compact_schedule
+import mortgage
+import portfolio
+import refinance
+
+LOAN = (200000, 250000, 0.05, 30, 7000, 0.0035, 100)
+TERMS = (15, 30, 40)
+EXTRAS = (0, 100)
+SIZES = {'1k': 1000, '1m': 1000000}
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASELINE_PATH = 'benchmark_baseline.json'
+THRESHOLD = 1.25  # slowdown ratio counted as a regression
+MIN_DELTA = 1e-4  # seconds; smaller slowdowns are timer noise
+SUITE = collections.OrderedDict()
+
+
+def benchmark(group):
+    """Registers a function returning {name: seconds} as a suite group"""
+    def register(func):
+        SUITE[group] = func
+        return func
+    return register
+
+
+def time_call(func, repeat=5, number=20):
+    """Returns the best time per call, in seconds"""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def loan_fixture(n, seed=0):
+    """Returns n reproducible loans cycling through TERMS, every other one with an extra payment"""
+    rng = np.random.default_rng(seed)
+    amount = rng.uniform(50000, 1000000, n).round(2)
+    price = (amount / rng.uniform(0.6, 0.97, n)).round(-3)
+    return pd.DataFrame({'amount': amount,
+                         'price': price,
+                         'rate': rng.uniform(0.02, 0.09, n).round(5),
+                         'term': np.resize(TERMS, n),
+                         'taxes': (price * rng.uniform(0.02, 0.04, n)).round(),
+                         'insurance': np.full(n, 0.0035),
+                         'additional': np.where(np.arange(n) % 2, rng.choice([100.0, 250.0, 1000.0], n), 0.0)})
+
+
+def single_loans(loan=LOAN):
+    """Yields (label, loan) for the single-loan fixture over every term and extra payment"""
+    for term in TERMS:
+        for extra in EXTRAS:
+            label = '{0}y{1}'.format(term, '.extra' if extra else '')
+            yield label, loan[:3] + (term,) + loan[4:6] + (extra,)
+
+
+def offline_taxes():
+    """Points taxes at the fixture tables and towns; returns the module, or None if it cannot be imported
+
+    The towns come from fixtures/taxes/towns.json. A local taxes_dict module
+    is not needed: when there is none, a stand-in built from the fixture is
+    registered so that taxes can be imported.
+    """
+    with open(os.path.join(FIXTURE_DIR, 'taxes', 'towns.json')) as f:
+        towns = json.load(f)
+    if 'taxes_dict' not in sys.modules and importlib.util.find_spec('taxes_dict') is None:
+        stub = types.ModuleType('taxes_dict')
+        stub.tax_dict = towns
+        sys.modules['taxes_dict'] = stub
+    try:
+        import taxes
+    except ImportError as e:
+        print('skipping tax benchmarks: {0}'.format(e), file=sys.stderr)
+        return None
+    taxes.load_tax_tables(os.path.join(FIXTURE_DIR, 'taxes', 'property_taxrates.html'), snapshot=None)
+    taxes.tax_dict = towns
+    taxes._INDEX = None
+    return taxes
+
+
+def bench_schedule_modes(loan=LOAN):
+    """Returns the time per schedule for each Mortgage schedule mode"""
+    timings = {}
+    for mode in amort.SCHEDULE_MODES:
+        m = amort.Mortgage(*loan, schedule_mode=mode)
+        timings[mode] = time_call(lambda: list(m.monthly_payment_schedule()))
+    return timings
+
+
+def bench_amortization_table(loan=LOAN, years=40):
+    """Returns the time per amortization_table for each schedule mode, and from the schedule cache"""
+    loan = loan[:3] + (years,) + loan[4:]
+    timings = {}
+    for mode in amort.SCHEDULE_MODES:
+        m = amort.Mortgage(*loan, schedule_mode=mode)
+        timings[mode] = time_call(lambda: (amort.SCHEDULE_CACHE.clear(), m.amortization_table()))
+    timings['cached'] = time_call(amort.Mortgage(*loan).amortization_table)
+    return timings
+
+
+def bench_rate_fetch(pages=16, delay=0.05):
+    """Returns the time to fetch lender pages from the fixture server, one at a time and pooled"""
+    import mortgage_rates
+    import rate_fixture_server
+    server, base_url = rate_fixture_server.start_server(delay=delay)
+    urls = [base_url + '/mandtbank?copy={0}'.format(i) for i in range(pages)]
+    try:
+        timings = {}
+        for name, pool_size in (('sequential', 1), ('pooled', mortgage_rates.POOL_SIZE)):
+            rates = mortgage_rates.Rates(base_url=base_url, pool_size=pool_size)
+            timings[name] = time_call(lambda: rates.fetch_all(urls), repeat=3, number=1)
+    finally:
+        server.shutdown()
+    return timings
+
+
+def bench_rate_history(days=730, lenders=4):
+    """Returns the time of a 90 day query over a synthetic daily rate history"""
+    import tempfile
+    import rate_history
+    rng = np.random.default_rng(0)
+    products = ['30 Year Fixed Rate'] + ['Product {0}'.format(i) for i in range(19)]
+    with tempfile.TemporaryDirectory() as path:
+        history = rate_history.RateHistory(path)
+        start = rate_history._timestamp('2020-01-01')
+        for day in range(days):
+            for lender in range(lenders):
+                table = pd.DataFrame({'loan type': products,
+                                      'rate': ['{0:.3f}%'.format(r) for r in rng.uniform(3, 7, len(products))],
+                                      'apr': ['{0:.3f}%'.format(r) for r in rng.uniform(3, 7, len(products))],
+                                      'points': '0.000'})
+                history.append('lender{0}'.format(lender), table, start + day * rate_history.DAY)
+        end = start + days * rate_history.DAY
+        return {'history.query': time_call(lambda: history.query('30 Year Fixed Rate', days=90, end=end))}
+
+
+@benchmark('schedule')
+def bench_schedules():
+    """Times monthly_payment_schedule for each mode over the single-loan fixtures"""
+    timings = {}
+    for label, loan in single_loans():
+        for mode, seconds in bench_schedule_modes(loan).items():
+            timings[mode + '.' + label] = seconds
+    return timings
+
+
+@benchmark('table')
+def bench_tables():
+    """Times amortization_table for each mode on a 40 year loan"""
+    return bench_amortization_table()
+
+
+@benchmark('portfolio')
+def bench_portfolio():
+    """Times the portfolio figures and schedules over the 1k and 1M loan fixtures"""
+    timings = {}
+    for size, n in SIZES.items():
+        loans = loan_fixture(n)
+        repeat, number = (5, 5) if n < 10000 else (3, 1)
+        timings['metrics.' + size] = time_call(lambda: portfolio.portfolio_metrics(loans), repeat, number)
+    loans = loan_fixture(SIZES['1k'])
+    timings['summary.1k'] = time_call(lambda: portfolio.portfolio_summary(loans), 3, 1)
+    timings['compact.1k'] = time_call(lambda: compact_schedule.CompactSchedule.from_loans(loans), 3, 1)
+    return timings
+
+
+@benchmark('sensitivity')
+def bench_sensitivity():
+    """Times the 3x3 sensitivity table and a larger sensitivity grid"""
+    amounts = np.linspace(100000, 1000000, 10)
+    rates = np.linspace(0.03, 0.08, 10)
+    return {'table': time_call(lambda: mortgage.sensitivity(150000, 4.5, 30)),
+            'grid': time_call(lambda: mortgage.sensitivity_grid(amounts, rates, TERMS, [0, 100, 250, 500, 1000]))}
+
+
+@benchmark('refinance')
+def bench_refinance():
+    """Times the refinance grid over growing numbers of loans and offers; time should grow with loans x offers"""
+    rng = np.random.default_rng(0)
+    timings = {}
+    for n_loans, n_offers in ((1000, 10), (1000, 100), (1000, 1000), (4000, 1000)):
+        loans = loan_fixture(n_loans).assign(months_paid=rng.integers(0, 120, n_loans))
+        offers = pd.DataFrame({'rate': rng.uniform(0.025, 0.08, n_offers).round(5),
+                               'term': rng.choice([10, 15, 20, 30], n_offers),
+                               'points': rng.choice([0, 0.5, 1, 2], n_offers),
+                               'closing_costs': rng.uniform(0, 6000, n_offers).round()})
+        label = 'grid.{0}x{1}'.format(n_loans, n_offers)
+        timings[label] = time_call(lambda: refinance.refinance_grid(loans, offers), 3, 1)
+    return timings
+
+
+@benchmark('taxes')
+def bench_taxes():
+    """Times the tax lookups against the offline fixture tables"""
+    taxes = offline_taxes()
+    if taxes is None:
+        return {}
+    prices = np.linspace(100000, 1000000, SIZES['1k'])
+
+    def cold_index():
+        taxes._INDEX = None
+        return taxes.tax_index()
+
+    return {'tax_rate': time_call(taxes.tax_rate),
+            'tax_index': time_call(cold_index),
+            'get_all_town_taxes': time_call(taxes.get_all_town_taxes),
+            'town_tax_bills.1k': time_call(lambda: taxes.town_tax_bills(prices))}
+
+
+@benchmark('afford')
+def bench_afford():
+    """Times the affordability and rent equivalence figures and a grid of 14,400 scenarios"""
+    taxes = offline_taxes()
+    if taxes is None:
+        return {}
+    import mortgage_all_in
+
+    def quiet(func, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*args)
+
+    incomes = np.linspace(30000, 300000, 20)
+    dtis = np.arange(15, 41, 5)
+    dps = [3.5, 5, 10, 20]
+    rates = np.linspace(3, 8, 6)
+    towns = list(taxes.tax_dict)
+    return {'afford': time_call(lambda: quiet(mortgage_all_in.afford, 65000, 25, 20)),
+            'rent_eqv': time_call(lambda: quiet(mortgage_all_in.rent_eqv, 1035)),
+            'grid.14k': time_call(lambda: mortgage_all_in.scenario_grid(incomes, dtis, dps, rates, towns, [1500]))}
+
+
+@benchmark('rates')
+def bench_rates():
+    """Times fetching lender pages from the local fixture server"""
+    return bench_rate_fetch()
+
+
+@benchmark('history')
+def bench_history():
+    """Times a query of the rate history"""
+    return bench_rate_history()
+
+
+def run_suite(groups=None):
+    """Runs the suite groups (all by default) and returns {group: {name: seconds}}"""
+    results = collections.OrderedDict()
+    for group, func in SUITE.items():
+        if groups and group not in groups:
+            continue
+        results[group] = func()
+    return results
+
+
+def flatten(results):
+    """Returns {'group.name': seconds} from run_suite results"""
+    return {group + '.' + name: seconds for group, timings in results.items() for name, seconds in timings.items()}
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    """Writes the flattened results with the machine and library versions to a JSON file"""
+    baseline = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'machine': platform.node(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'pandas': pd.__version__,
+                'results': flatten(results)}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path=BASELINE_PATH):
+    """Returns the {'group.name': seconds} results of a saved baseline"""
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def regressions(results, baseline, threshold=THRESHOLD, min_delta=MIN_DELTA):
+    """Returns (name, baseline, current, ratio) for every benchmark slower than baseline * threshold
+
+    Slowdowns under min_delta seconds are ignored, and benchmarks missing
+    from either side are not compared.
+    """
+    slow = []
+    for name, seconds in sorted(flatten(results).items()):
+        if name in baseline and seconds > baseline[name] * threshold and seconds - baseline[name] > min_delta:
+            slow.append((name, baseline[name], seconds, seconds / baseline[name]))
+    return slow
+
+
+def reference_name(name, timings, reference='decimal'):
+    """Returns the entry a timing is compared against, or None
+
+    That is the reference entry itself, or for a 'mode.label' name the
+    'reference.label' entry, so 'cents.30y' is compared with 'decimal.30y'.
+    """
+    if reference in timings:
+        return reference
+    label = name.partition('.')[2]
+    if label and reference + '.' + label in timings:
+        return reference + '.' + label
+    return None
+
+
+def print_timings(title, timings, reference='decimal'):
+    """Prints the timings, relative to their reference entry when there is one"""
+    print(title)
+    print('-' * 50)
+    for name, seconds in timings.items():
+        ref = reference_name(name, timings, reference)
+        if ref:
+            print('{0:>24s}: {1:>9.3f} ms  {2:>6.1f}x'.format(name, seconds * 1000, timings[ref] / seconds))
+        else:
+            print('{0:>24s}: {1:>9.3f} ms'.format(name, seconds * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mortgage benchmark suite')
+    parser.add_argument('--only', nargs='+', default=None, choices=list(SUITE), dest='groups',
+                        help='groups to run; all by default')
+    parser.add_argument('--save', nargs='?', const=BASELINE_PATH, default=None, dest='save',
+                        help='write the results as a baseline (default %(const)s)')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH, default=None, dest='compare',
+                        help='compare against a baseline and exit 1 on a regression')
+    parser.add_argument('--threshold', default=THRESHOLD, type=float, dest='threshold',
+                        help='slowdown ratio counted as a regression (default %(default)s)')
+    args = parser.parse_args()
+
+    results = run_suite(args.groups)
+    for group, timings in results.items():
+        reference = 'sequential' if group == 'rates' else 'decimal'
+        print_timings(group, timings, reference)
+        print('')
+    if args.save:
+        save_baseline(results, args.save)
+        print('baseline written to ' + args.save)
+    if args.compare:
+        slow = regressions(results, load_baseline(args.compare), args.threshold)
+        for name, before, after, ratio in slow:
+            print('REGRESSION {0}: {1:.3f} ms -> {2:.3f} ms ({3:.2f}x)'.format(name, before * 1000, after * 1000, ratio))
+        if slow:
+            sys.exit(1)
+        print('no regressions beyond {0:.2f}x'.format(args.threshold))
+
+
+if __name__ == '__main__':
+    main()
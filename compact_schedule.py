@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+compact_schedule.py
+
+Amortization schedules stored as int64 cent columns. A schedule set holds
+any number of loans back to back, with a lengths array marking where each
+loan's rows start, so a row costs 48 bytes instead of a tuple of six boxed
+floats.
+
+A set is saved as a directory with one raw little-endian int64 file per
+column plus the lengths and loan ids as .npy files. Reopening it maps the
+files into memory, so multi-million-loan sets load without parsing.
+"""
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import amortization_table as amort
+import schedule_export
+
+COLUMN_FILES = ['beg_balance', 'monthly_payment', 'additional_payment', 'interest', 'principal', 'end_balance']
+CENTS_DTYPE = np.dtype('<i8')
+
+
+def to_cents(values):
+    """Returns dollar amounts as int64 cents, rounded up to the cent like Mortgage.dollar"""
+    return np.rint(amort.quantize_array(values) * 100).astype(CENTS_DTYPE)
+
+
+class CompactSchedule:
+    """Amortization schedules of one or more loans as int64 cent columns
+
+    Every figure of the schedule is already a whole number of cents except
+    the cut-down additional payment of a loan's last month, which is rounded
+    up to the cent like the other figures.
+
+        Args:
+            columns: six int64 arrays ordered like SCHEDULE_COLUMNS
+            lengths: number of rows of each loan
+            loan_ids: an id per loan; defaults to the loan positions
+    """
+    __slots__ = ('columns', 'lengths', 'starts', 'loan_ids')
+
+    def __init__(self, columns, lengths, loan_ids=None):
+        self.columns = tuple(columns)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.starts = np.cumsum(self.lengths) - self.lengths
+        self.loan_ids = np.arange(len(self.lengths)) if loan_ids is None else np.asarray(loan_ids)
+
+    @classmethod
+    def from_columns(cls, lengths, columns, loan_ids=None):
+        """Returns a schedule set from the float columns of schedule_columns"""
+        return cls([to_cents(column) for column in columns], lengths, loan_ids)
+
+    @classmethod
+    def build(cls, amount, rate, term, additional=0, payment=None, loan_ids=None):
+        """Returns the schedules of loans given as scalars or equal-length arrays"""
+        lengths, columns = amort.schedule_columns(amount, rate, term, additional, payment)
+        return cls.from_columns(lengths, columns, loan_ids)
+
+    @classmethod
+    def from_loans(cls, loans, chunk_size=schedule_export.CHUNK_SIZE):
+        """Returns the schedules of Mortgages, loan mappings or DataFrames of loans
+
+        Loans are scheduled chunk by chunk, so only the compact columns of the
+        whole set are held at once.
+        """
+        parts = [cls.build(chunk['amount'], chunk['rate'], chunk['term'], chunk['additional'],
+                           chunk['payment'], chunk['loan_id'])
+                 for chunk in schedule_export.loan_chunks(loans, chunk_size)]
+        return cls([np.concatenate([p.columns[i] for p in parts]) for i in range(len(COLUMN_FILES))],
+                   np.concatenate([p.lengths for p in parts]),
+                   np.concatenate([p.loan_ids for p in parts]))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def rows(self):
+        """Returns the number of schedule rows over all loans"""
+        return len(self.columns[0])
+
+    @property
+    def nbytes(self):
+        """Returns the bytes held by the columns and the loan index"""
+        return sum(c.nbytes for c in self.columns) + self.lengths.nbytes + self.starts.nbytes + self.loan_ids.nbytes
+
+    def loan(self, i):
+        """Returns the schedule of the i-th loan, sharing this set's memory"""
+        rows = slice(self.starts[i], self.starts[i] + self.lengths[i])
+        return CompactSchedule([c[rows] for c in self.columns], self.lengths[i:i + 1], self.loan_ids[i:i + 1])
+
+    def dollars(self, name):
+        """Returns one column, by SCHEDULE_COLUMNS name, as float dollars"""
+        return self.columns[amort.SCHEDULE_COLUMNS.index(name)] / 100
+
+    def to_frame(self, cents=False):
+        """Returns the schedules as a DataFrame
+
+        With cents=True the int64 columns are used without copying. A single
+        loan is indexed by month from 1, as in Mortgage.amortization_table;
+        several loans by loan id and month.
+        """
+        columns = self.columns if cents else [c / 100 for c in self.columns]
+        if len(self) == 1:
+            index = pd.RangeIndex(1, self.rows + 1)
+        else:
+            months = np.arange(self.rows) - np.repeat(self.starts, self.lengths) + 1
+            index = pd.MultiIndex.from_arrays([np.repeat(self.loan_ids, self.lengths), months],
+                                              names=['Loan ID', 'Month'])
+        return pd.DataFrame(dict(zip(amort.SCHEDULE_COLUMNS, columns)), index=index, copy=False)
+
+    def save(self, path):
+        """Writes the schedule set to the directory path"""
+        return write_schedules([self], path)
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        """Maps a saved schedule set into memory; mode is 'r' or 'r+' as for np.memmap"""
+        lengths = np.load(os.path.join(path, 'lengths.npy'))
+        loan_ids = np.load(os.path.join(path, 'loan_ids.npy'))
+        columns = [np.memmap(os.path.join(path, name + '.i8'), dtype=CENTS_DTYPE, mode=mode)
+                   if lengths.sum() else np.zeros(0, dtype=CENTS_DTYPE)
+                   for name in COLUMN_FILES]
+        return cls(columns, lengths, loan_ids)
+
+
+def write_schedules(loans, path, chunk_size=schedule_export.CHUNK_SIZE):
+    """Streams the schedules of many loans to a schedule set directory
+
+    Args:
+        loans: CompactSchedule objects, or anything loan_chunks accepts
+        path: directory to write; created if needed
+
+    Returns:
+        int: number of schedule rows written
+    """
+    if isinstance(loans, pd.DataFrame):
+        loans = [loans]
+    os.makedirs(path, exist_ok=True)
+    files = [open(os.path.join(path, name + '.i8'), 'wb') for name in COLUMN_FILES]
+    lengths, loan_ids = [], []
+    try:
+        for part in _compact_parts(loans, chunk_size):
+            for f, column in zip(files, part.columns):
+                f.write(np.ascontiguousarray(column, dtype=CENTS_DTYPE).tobytes())
+            lengths.append(part.lengths)
+            loan_ids.append(part.loan_ids)
+    finally:
+        for f in files:
+            f.close()
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    np.save(os.path.join(path, 'lengths.npy'), lengths)
+    loan_ids = np.concatenate(loan_ids) if loan_ids else np.zeros(0, dtype=int)
+    if loan_ids.dtype == object:
+        # np.save pickles object arrays, which np.load refuses by default
+        loan_ids = loan_ids.astype(str)
+    np.save(os.path.join(path, 'loan_ids.npy'), loan_ids)
+    return int(lengths.sum())
+
+
+def _compact_parts(loans, chunk_size):
+    """Yields CompactSchedule parts, scheduling any loans that are not already compact"""
+    pending = []
+    for loan in loans:
+        if isinstance(loan, CompactSchedule):
+            if pending:
+                yield CompactSchedule.from_loans(pending, chunk_size)
+                pending = []
+            yield loan
+        elif isinstance(loan, pd.DataFrame):
+            for chunk in schedule_export.loan_chunks(loan, chunk_size):
+                yield CompactSchedule.build(chunk['amount'], chunk['rate'], chunk['term'], chunk['additional'],
+                                            chunk['payment'], chunk['loan_id'])
+        else:
+            pending.append(loan)
+            if len(pending) == chunk_size:
+                yield CompactSchedule.from_loans(pending, chunk_size)
+                pending = []
+    if pending:
+        yield CompactSchedule.from_loans(pending, chunk_size)
+
+
+def test():
+    """Checks compact schedules against Mortgage tables and a saved round trip"""
+    import tempfile
+    import portfolio
+    loans = portfolio.sample_loans(loan_id=[11, 12, 13])
+    compact = CompactSchedule.from_loans(loans)
+    named = loans.assign(loan_id=['A-1', 'B-2', 'C-3'])
+    for i, m in enumerate(portfolio.mortgages(loans)):
+        table = m.amortization_table()[amort.SCHEDULE_COLUMNS]
+        frame = compact.loan(i).to_frame()
+        assert frame.index.equals(table.index), i
+        assert np.abs(frame.values - table.values).max() < 0.01, i
+    frame = compact.to_frame(cents=True)
+    assert np.shares_memory(frame['Interest'].to_numpy(), compact.columns[3])
+    with tempfile.TemporaryDirectory() as path:
+        assert write_schedules(loans, path, chunk_size=2) == compact.rows
+        reopened = CompactSchedule.open(path)
+        assert isinstance(reopened.columns[0], np.memmap)
+        assert reopened.to_frame().equals(compact.to_frame())
+        del reopened, frame
+        write_schedules(named, path)
+        assert list(CompactSchedule.open(path).loan_ids) == ['A-1', 'B-2', 'C-3']
+    print('compact schedule ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the schedules of a loan file as a compact schedule set')
+    parser.add_argument('loan_file', help='CSV or Parquet file of loans')
+    parser.add_argument('output', help='directory for the schedule set')
+    parser.add_argument('--chunk-size', default=schedule_export.CHUNK_SIZE, type=int, dest='chunk_size')
+    args = parser.parse_args()
+    rows = write_schedules(schedule_export.read_loan_file(args.loan_file, args.chunk_size), args.output,
+                           args.chunk_size)
+    print('{0:,d} schedule rows written to {1}'.format(rows, args.output))
+
+
+if __name__ == '__main__':
+    main()
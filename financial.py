@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+financial.py
+
+Time value of money functions with the spreadsheet sign conventions: money
+received is positive and money paid out is negative, rates are per period
+and `when` is 'end' (0) or 'begin' (1).
+
+Every function broadcasts over NumPy arrays and handles a zero rate. Plain
+scalar arguments are computed with the math module, so single-loan callers
+do not pay for array overhead or for importing NumPy.
+"""
+import math
+import numbers
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+
+def _when(when):
+    """Returns 0 for payments at the end of a period and 1 for the beginning"""
+    if isinstance(when, str):
+        return {'end': 0, 'begin': 1}[when]
+    return when
+
+
+_PLAIN = (float, int, bool)
+
+
+def _scalar(*args):
+    """Returns True if every argument is a plain number or a NumPy scalar"""
+    for a in args:
+        if type(a) not in _PLAIN and not isinstance(a, numbers.Number) and getattr(a, 'ndim', None) != 0:
+            return False
+    return True
+
+
+def _arrays(*args):
+    """Returns the arguments unchanged if they are all scalars, else as arrays"""
+    if _scalar(*args):
+        return args
+    return tuple(np.asarray(a, dtype=float) for a in args)
+
+
+def _where(condition, x, y):
+    """Elementwise choice that falls back to a plain conditional for scalars"""
+    if _scalar(condition, x, y):
+        return x if condition else y
+    return np.where(condition, x, y)
+
+
+def _nonzero(rate):
+    """Returns the rate with zeros replaced by 1, to keep divisions finite"""
+    if _scalar(rate):
+        return rate or 1.0
+    return np.where(rate == 0, 1.0, rate)
+
+
+def _log(x):
+    """Natural log that returns nan/-inf instead of raising for scalars"""
+    if _scalar(x):
+        if x > 0:
+            return math.log(x)
+        return -math.inf if x == 0 else math.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log(x)
+
+
+def _annuity(rate, nper, when):
+    """Returns the future value factor of a payment of 1 per period"""
+    return _where(rate == 0, nper, (1 + rate * when) * ((1 + rate) ** nper - 1) / _nonzero(rate))
+
+
+def fv(rate, nper, pmt, pv, when='end'):
+    """Returns the future value of a loan or investment"""
+    when = _when(when)
+    rate, nper, pmt, pv = _arrays(rate, nper, pmt, pv)
+    return -(pv * (1 + rate) ** nper + pmt * _annuity(rate, nper, when))
+
+
+_fv = fv
+
+
+def pv(rate, nper, pmt, fv=0, when='end'):
+    """Returns the present value of a series of payments"""
+    when = _when(when)
+    rate, nper, pmt, fv = _arrays(rate, nper, pmt, fv)
+    return -(fv + pmt * _annuity(rate, nper, when)) / (1 + rate) ** nper
+
+
+def pmt(rate, nper, pv, fv=0, when='end'):
+    """Returns the payment per period that pays off pv (and reaches fv) in nper periods"""
+    when = _when(when)
+    rate, nper, pv, fv = _arrays(rate, nper, pv, fv)
+    return -(fv + pv * (1 + rate) ** nper) / _annuity(rate, nper, when)
+
+
+def nper(rate, pmt, pv, fv=0, when='end'):
+    """Returns the number of periods to pay off pv (and reach fv)
+
+    nan when the payment never gets there.
+    """
+    when = _when(when)
+    rate, pmt, pv, fv = _arrays(rate, pmt, pv, fv)
+    safe = _nonzero(rate)
+    z = pmt * (1 + safe * when) / safe
+    if _scalar(rate, pmt, pv, fv):
+        return -(fv + pv) / pmt if rate == 0 else _log((z - fv) / (pv + z)) / _log(1 + safe)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        periods = np.log((z - fv) / (pv + z)) / np.log(1 + safe)
+        return np.where(rate == 0, -(fv + pv) / pmt, periods)
+
+
+def ipmt(rate, per, nper, pv, fv=0, when='end'):
+    """Returns the interest portion of the payment in period per (from 1)"""
+    when = _when(when)
+    rate, per, nper, pv, fv = _arrays(rate, per, nper, pv, fv)
+    total = pmt(rate, nper, pv, fv, when)
+    interest = _fv(rate, per - 1, total, pv, when) * rate
+    if when:
+        # payments at the beginning earn no interest in the first period
+        interest = _where(per == 1, 0.0, interest / (1 + rate))
+    return _where((per < 1) | (per > nper), math.nan, interest)
+
+
+def ppmt(rate, per, nper, pv, fv=0, when='end'):
+    """Returns the principal portion of the payment in period per (from 1)"""
+    return pmt(rate, nper, pv, fv, when) - ipmt(rate, per, nper, pv, fv, when)
+
+
+def rate(nper, pmt, pv, fv=0, when='end', guess=0.1, tol=1e-10, maxiter=100):
+    """Returns the rate per period, solved with Newton's method
+
+    nan where the iteration does not converge.
+    """
+    when = _when(when)
+    nper, pmt, pv, fv = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (nper, pmt, pv, fv)))
+    r = np.full(nper.shape, float(guess))
+    converged = np.zeros(nper.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(maxiter):
+            growth = (1 + r) ** nper
+            annuity = (1 + r * when) * (growth - 1) / r
+            f = pv * growth + pmt * annuity + fv
+            d_growth = nper * (1 + r) ** (nper - 1)
+            d_annuity = when * (growth - 1) / r + (1 + r * when) * (d_growth / r - (growth - 1) / r ** 2)
+            step = f / (pv * d_growth + pmt * d_annuity)
+            r = np.where(converged, r, r - step)
+            converged |= np.abs(step) < tol
+            if converged.all():
+                break
+    r = np.where(converged, r, np.nan)
+    return r[()] if r.ndim == 0 else r
+
+
+def _balance(rate, per, payment, pv, when):
+    """Returns the balance left after the payment of period per"""
+    left = -fv(rate, per, payment, pv, when)
+    if when:
+        # fv includes the interest accrued after a beginning-of-period payment
+        left = _where(per == 0, pv, left / (1 + rate))
+    return left
+
+
+def cumprinc(rate, nper, pv, start, end, when='end'):
+    """Returns the principal paid from period start to end inclusive (negative for a loan)"""
+    when = _when(when)
+    rate, nper, pv, start, end = _arrays(rate, nper, pv, start, end)
+    total = pmt(rate, nper, pv, 0, when)
+    return _balance(rate, end, total, pv, when) - _balance(rate, start - 1, total, pv, when)
+
+
+def cumipmt(rate, nper, pv, start, end, when='end'):
+    """Returns the interest paid from period start to end inclusive (negative for a loan)"""
+    total = pmt(rate, nper, pv, 0, when)
+    return total * (end - start + 1) - cumprinc(rate, nper, pv, start, end, when)
+
+
+# (function, args, kwargs, spreadsheet value) from the worked examples in the
+# spreadsheet documentation, plus zero-rate cases
+_REFERENCE = [(pmt, (0.08 / 12, 10, 10000), {}, -1037.03208935916),
+              (pmt, (0.08 / 12, 10, 10000), {'when': 'begin'}, -1030.16432717798),
+              (pmt, (0, 12, 1200), {}, -100.0),
+              (pmt, (0, 12, 1200), {'when': 'begin'}, -100.0),
+              (fv, (0.06 / 12, 10, -200, -500), {'when': 'begin'}, 2581.40337406012),
+              (fv, (0.12 / 12, 12, -1000, 0), {}, 12682.5030131970),
+              (fv, (0.11 / 12, 35, -2000, 0), {'when': 'begin'}, 82846.2463719004),
+              (fv, (0, 12, -100, 0), {}, 1200.0),
+              (pv, (0.08 / 12, 240, 500), {}, -59777.1458511878),
+              (pv, (0, 12, -100), {}, 1200.0),
+              (nper, (0.12 / 12, -100, -1000, 10000), {'when': 'begin'}, 59.6738656742946),
+              (nper, (0.12 / 12, -100, -1000, 10000), {}, 60.0821228537617),
+              (nper, (0.12 / 12, -100, -1000), {}, -9.57859403981317),
+              (nper, (0, -100, 1200), {}, 12.0),
+              (ipmt, (0.10 / 12, 1, 36, 8000), {}, -66.6666666666667),
+              (ipmt, (0.10, 3, 3, 8000), {}, -292.447129909366),
+              (ipmt, (0.10 / 12, 1, 36, 8000), {'when': 'begin'}, 0.0),
+              (ipmt, (0, 3, 12, 1200), {}, 0.0),
+              (ppmt, (0.10 / 12, 1, 24, 2000), {}, -75.6231860083666),
+              (ppmt, (0.08, 10, 10, 200000), {}, -27598.0534624214),
+              (ppmt, (0.10 / 12, 1, 24, 2000), {'when': 'begin'}, -91.5271266198677),
+              (rate, (48, -200, 8000), {}, 0.00770147248820165),
+              (cumipmt, (0.09 / 12, 360, 125000, 13, 24), {}, -11135.2321307508),
+              (cumipmt, (0.09 / 12, 360, 125000, 1, 1), {}, -937.5),
+              (cumipmt, (0.09 / 12, 360, 125000, 1, 1), {'when': 'begin'}, 0.0),
+              (cumprinc, (0.09 / 12, 360, 125000, 13, 24), {}, -934.107123420869),
+              (cumprinc, (0.09 / 12, 360, 125000, 1, 1), {}, -68.2782711809784),
+              (cumprinc, (0, 12, 1200, 1, 6), {}, -600.0)]
+
+
+def test():
+    """Checks every function against spreadsheet values, as scalars and as arrays"""
+    for func, args, kwargs, expected in _REFERENCE:
+        got = func(*args, **kwargs)
+        assert math.isclose(got, expected, rel_tol=1e-9, abs_tol=1e-9), (func.__name__, args, kwargs, got)
+        # the array path must agree with the scalar fast path
+        arrays = [np.full(2, a, dtype=float) for a in args]
+        assert np.allclose(func(*arrays, **kwargs), expected, rtol=1e-9, atol=1e-9), (func.__name__, args, kwargs)
+    print('financial ok')
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lazy.py
+
+Deferred imports for the heavy libraries. A module returned by
+lazy_import is only executed on its first attribute access, so entry
+points that never touch NumPy or pandas do not pay for importing them.
+"""
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Returns the named module, loading it on first use if it is not imported yet"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named ' + repr(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
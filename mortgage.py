@@ -10,8 +10,55 @@ User interface for the mortgage program
 """
 
 import os
-import amortization_table as amort
+import numpy as np
+import financial as fin
 import pandas as pd
+import portfolio
+
+GRID_AXES = ['amount', 'rate', 'term', 'additional', 'price', 'taxes', 'insurance']
+GRID_METRICS = ['monthly_payment', 'piti', 'total_interest', 'payoff_months']
+
+
+def sensitivity_grid(amount, rate, term=30, additional=0, price=None, taxes=0, insurance=0):
+    """Returns payment figures over every combination of the given axis values
+
+    Each argument is a value or a sequence of values. The figures are computed
+    in one broadcast over the whole grid. Insurance follows the Mortgage
+    convention (annual rate on the price); when no price is given it applies
+    to the loan amount. Total interest and payoff months with an additional
+    payment come from the closed-form annuity, before cent rounding.
+
+    Returns:
+        DataFrame indexed by the axes with a column per GRID_METRICS entry
+    """
+    values = {'amount': amount, 'rate': rate, 'term': term, 'additional': additional,
+              'price': amount if price is None else price, 'taxes': taxes, 'insurance': insurance}
+    axes = [name for name in GRID_AXES if not (name == 'price' and price is None)]
+    levels = [np.atleast_1d(np.asarray(values[name], dtype=float)) for name in axes]
+    grid = {}
+    for i, (name, level) in enumerate(zip(axes, levels)):
+        shape = [1] * len(axes)
+        shape[i] = -1
+        grid[name] = level.reshape(shape)
+    if price is None:
+        grid['price'] = grid['amount']
+
+    metrics = portfolio.portfolio_metrics(grid)
+    monthly_rate = grid['rate'] / 12
+    paid = metrics['monthly_payment'] + grid['additional']
+    # the tolerance keeps float noise from adding a month to an exact term
+    months = np.minimum(np.ceil(fin.nper(monthly_rate, -paid, grid['amount']) - 1e-9), grid['term'] * 12)
+    # every payment is in full but the last, which clears the balance left, as in Mortgage.total_interest
+    left = np.maximum(-fin.fv(monthly_rate, months - 1, -paid, grid['amount']), 0.0)
+    shape = np.broadcast_shapes(*(grid[name].shape for name in axes))
+    data = {'monthly_payment': metrics['monthly_payment'],
+            'piti': metrics['piti'],
+            'total_interest': paid * (months - 1) + left * (1 + monthly_rate) - grid['amount'],
+            'payoff_months': months}
+    data = {k: np.broadcast_to(v, shape).ravel() for k, v in data.items()}
+    index = pd.MultiIndex.from_product(levels, names=axes)
+    return pd.DataFrame(data, index=index, columns=GRID_METRICS)
+
 
 def sensitivity(amount, rate, term):
     """Returns 3x3 dataframe with sensitized interest rates and house prices"""
@@ -22,18 +69,31 @@ def sensitivity(amount, rate, term):
     amounts = [a, a + 25000, a + 50000]
     rates = [r, r + .0075, r + .0150]
 
-    s_dict = {}
-    for amount in amounts:
-        s_list = []
-        for rate in rates:
-            m = amort.Mortgage(amount, rate, 30)
-            m.amortization_table()
-            x = m.monthly_payment()
-            s_list.append(x)
-        s_dict[amount] = s_list
-
-    df = pd.DataFrame.from_dict(s_dict, orient='index')
+    df = sensitivity_grid(amounts, rates, t)['monthly_payment']
+    df = df.droplevel(['term', 'additional', 'taxes', 'insurance']).unstack('rate')
+    df.index.name = None
     df.columns = rates
     return df
 
-print(sensitivity(150000, 4.5, 30))
\ No newline at end of file
+def test():
+    """Checks sampled grid cells against the Mortgage figures of the same loan"""
+    import amortization_table as amort
+    grid = sensitivity_grid([87500, 200000, 453210.55], [0, 0.04125, 0.0699], [15, 30, 40], [0, 333.33, 5000],
+                            [250000, 500000], [2500, 9000], [0.0035])
+    assert len(grid) == 3 * 3 * 3 * 3 * 2 * 2
+    rng = np.random.default_rng(0)
+    for i in rng.choice(len(grid), 60, replace=False):
+        amount, rate, term, additional, price, taxes, insurance = grid.index[i]
+        m = amort.Mortgage(amount, price, rate, int(term), taxes, insurance, additional)
+        row = grid.iloc[i]
+        assert np.isclose(row['monthly_payment'], m.monthly_payment()), grid.index[i]
+        assert np.isclose(row['piti'], m.piti()), grid.index[i]
+        assert np.isclose(row['total_interest'], m.total_interest()), grid.index[i]
+        assert row['payoff_months'] == m.payoff_months(), grid.index[i]
+    # without a price, insurance is on the amount
+    m = amort.Mortgage(200000, 200000, 0.05, 30, 0, 0.0035, 100)
+    assert np.isclose(sensitivity_grid(200000, 0.05, additional=100, insurance=0.0035)['piti'].item(), m.piti())
+    print('sensitivity grid ok')
+
+if __name__ == '__main__':
+    print(sensitivity(150000, 4.5, 30))
@@ -6,39 +6,147 @@ mortgage_all_in.py
 
 Estimate the all-in costs of a mortgage (PITI) as a % of sale price.
 
+Affordability and rent equivalence invert the PITI of a house: the loan
+payment on the price less the down payment, the town's property taxes on
+the price and insurance as an annual rate on the price, like Mortgage.
+Every part is linear in the price, so the price that a monthly budget
+affords is solved in closed form for whole arrays of scenarios at once.
+
 '''
+import argparse
 import numpy as np
-import taxes as tax
+import pandas as pd
+import amortization_table as amort
+import financial as fin
+
+RATE = 4.0  # annual %
+TERM = 30  # years
+TOWN = 'Fairport'
+INSURANCE = 0.0035  # annual insurance as a fraction of price
+AFFORD_COLUMNS = ['income', 'dti', 'dp', 'rate', 'term', 'town', 'price', 'loan', 'down_payment', 'piti',
+                  'taxes', 'insurance', 'rent', 'rent_price']
+
+def tax_terms(town=TOWN, tax_rate=None, df=None):
+    """Returns the annual tax per $ of price and the flat $ charges of an array of towns
+
+    tax_rate (annual % of price), when given, is used instead of the towns' rates.
+    """
+    if tax_rate is not None:
+        return np.asarray(tax_rate, dtype=float) / 100, 0.0
+    import taxes as tax  # loads the tax tables, so only when needed
+    towns = np.asarray(town, dtype=object)
+    # thousands of scenarios share a handful of towns, so look each one up once
+    names, inverse = np.unique(towns.ravel(), return_inverse=True)
+    per_dollar, flat = tax.loan_tax_terms(names, df)
+    return per_dollar[inverse].reshape(towns.shape), flat[inverse].reshape(towns.shape)
+
+def solve(income, dti, dp=20, rate=RATE, town=TOWN, rent=np.nan, term=TERM, insurance=INSURANCE,
+          tax_rate=None, df=None):
+    """Returns the most house each scenario affords and the house its rent pays for
+
+    Args:
+        income (float): annual income
+        dti (float): % of income that goes to PITI
+        dp (float): down payment as a % of price
+        rate (float): annual mortgage rate in %
+        town (str): municipality in taxes.tax_dict
+        rent (float): monthly rent to find the equivalent house for
+        term (int): loan years
+        insurance (float): annual insurance as a fraction of price
+        tax_rate (float): annual taxes as a % of price, instead of the town's
+        df: tax tables; the taxes module's own by default
+
+    Every argument but df may be an array; they are broadcast together.
+
+    Returns:
+        dict of arrays with AFFORD_COLUMNS; price and rent_price are nan for
+        an unknown town
+    """
+    income, dti, dp, rate, term, rent = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in
+                                                              (income, dti, dp, rate, term, rent)))
+    town = np.broadcast_to(np.asarray(town, dtype=object), income.shape)
+    tax_per_dollar, flat = tax_terms(town, tax_rate, df)
+    # monthly PITI = price * per_dollar + fixed
+    loan_payment = (-fin.pmt(rate / 100 / amort.Mortgage.MONTHS_IN_YEAR, term * amort.Mortgage.MONTHS_IN_YEAR, 1.0)
+                    * (1 - dp / 100))
+    per_dollar = loan_payment + (tax_per_dollar + insurance) / amort.Mortgage.MONTHS_IN_YEAR
+    fixed = flat / amort.Mortgage.MONTHS_IN_YEAR
+    piti = income * dti / 100 / amort.Mortgage.MONTHS_IN_YEAR
+    price = np.maximum(piti - fixed, 0) / per_dollar
+    return {'income': income, 'dti': dti, 'dp': dp, 'rate': rate, 'term': term, 'town': town,
+            'price': price,
+            'loan': price * (1 - dp / 100),
+            'down_payment': price * dp / 100,
+            'piti': piti,
+            'taxes': price * tax_per_dollar + flat,
+            'insurance': price * insurance,
+            'rent': rent,
+            'rent_price': np.maximum(rent - fixed, 0) / per_dollar}
 
-def rate_table(rates):
-    t = tax.get_town_tax_rate()
-    i = 1000 / 200000
-    tandi = t + i
+def scenario_grid(incomes, dtis, dps=(20,), rates=(RATE,), towns=(TOWN,), rents=(np.nan,), term=TERM,
+                  insurance=INSURANCE, tax_rate=None, df=None):
+    """Returns solve over every combination of the values given, as a DataFrame
+
+    Rows are ordered with the last argument varying fastest.
+    """
+    axes = [np.asarray(a, dtype=object if i == 4 else float)
+            for i, a in enumerate((incomes, dtis, dps, rates, towns, rents))]
+    income, dti, dp, rate, town, rent = (a.ravel() for a in np.meshgrid(*axes, indexing='ij'))
+    result = solve(income, dti, dp, rate, town, rent, term, insurance, tax_rate, df)
+    return pd.DataFrame(result, columns=AFFORD_COLUMNS)
+
+def rate_table(rates, price=200000, town=TOWN, insurance=INSURANCE, term=TERM):
+    import taxes as tax  # loads the tax tables, so only when needed
+    t = tax.get_town_tax_rate(town, price)
+    tandi = t + insurance
     for rate in rates:
-            all_in_m = (np.pmt(rate / 100 / 12, 360, -200000) * 12) / 200000
+            all_in_m = fin.pmt(rate / 100 / 12, term * 12, -1) * 12
             total = all_in_m + tandi
             print('{0:.2f}%  {1:.2f}%  {2:.2f}x  {3:.2f}%  {4:.2f}x'.format(rate, all_in_m*100, all_in_m*100 / (rate), (total)*100, (total)*100 / (rate) ))
 
 # calc current rent equivelant in terms of house price
 
-def rent_eqv(rent):
-    a_rent = rent * 12 # annualize rent payments
-    cap_rate = .0956 # all in PITI % at 4% for 30, with 3.83% in T & I
-    eqv_loan = a_rent / cap_rate # calc pv of loan with total payments equal to rent payment
-    price = eqv_loan / 0.80 # assume 20% down payment (80% LTV)
-    print("You're current rent of ${0:,.0f} is equivelant to PITI payments on a ${1:,.0f} house.".format(rent, price))
-
-def afford(income, dti, dp=20):
-    a_pmts = income * dti/100
-    cap_rate = .0956 # all in PITI % at 4% for 30, with 3.83% in T & I
-    value = a_pmts / cap_rate # loan value
-    house = value/(1-(dp/100))# calc the house price based on loan value
-    print('With an income of ${0:,.0f} and a {1:,.0f}% down payment you can afford a ${2:,.0f} house with a {3:.0f}% DTI ratio. Monthly payments = ${4:,.0f}. Down payment = ${5:,.0f}'.format(income, dp, house, dti, a_pmts/12, house/5))
-
-rate_table([4.0])
-rent_eqv(1035)
-dtis = range(20,31,5)
-dps = range(10,21,5)
-for i in dtis:
-    for j in dps:
-        afford(65000, i, j)
\ No newline at end of file
+def rent_eqv(rent, dp=20, rate=RATE, town=TOWN):
+    price = solve(0, 0, dp, rate, town, rent)['rent_price']
+    print("You're current rent of ${0:,.0f} is equivelant to PITI payments on a ${1:,.0f} house.".format(rent, float(price)))
+
+def _afford_string(income, dti, dp, price, piti, down_payment):
+    return 'With an income of ${0:,.0f} and a {1:,.0f}% down payment you can afford a ${2:,.0f} house with a {3:.0f}% DTI ratio. Monthly payments = ${4:,.0f}. Down payment = ${5:,.0f}'.format(income, dp, price, dti, piti, down_payment)
+
+def afford(income, dti, dp=20, rate=RATE, town=TOWN):
+    r = solve(income, dti, dp, rate, town)
+    print(_afford_string(income, dti, dp, float(r['price']), float(r['piti']), float(r['down_payment'])))
+
+def test():
+    """Checks that Mortgage PITI at the solved prices equals the budgets"""
+    grid = scenario_grid([40000, 65000, 150000], [20, 25, 30, 36], [3.5, 10, 20], [0, 4.0, 7.25], [TOWN],
+                         [1035, 2400], tax_rate=3.2)
+    assert len(grid) == 3 * 4 * 3 * 3 * 2
+    for r in grid.itertuples(index=False):
+        m = amort.Mortgage(r.loan, r.price, r.rate / 100, r.term, r.taxes, INSURANCE)
+        assert np.isclose(m.piti(), r.piti), r
+        assert np.isclose(r.taxes, r.price * 0.032)
+        m = amort.Mortgage(r.rent_price * (1 - r.dp / 100), r.rent_price, r.rate / 100, r.term,
+                           r.rent_price * 0.032, INSURANCE)
+        assert np.isclose(m.piti(), r.rent), r
+    print('afford ok')
+
+def main():
+    parser = argparse.ArgumentParser(description='Most house an income affords and the house a rent pays for')
+    parser.add_argument('-i', '--income', nargs='+', default=[65000], type=float, dest='income')
+    parser.add_argument('-d', '--dti', nargs='+', default=[20, 25, 30], type=float, dest='dti',
+                        help='%% of income going to PITI')
+    parser.add_argument('-p', '--dp', nargs='+', default=[10, 15, 20], type=float, dest='dp',
+                        help='down payment, %% of price')
+    parser.add_argument('-r', '--rate', nargs='+', default=[RATE], type=float, dest='rate', help='annual %%')
+    parser.add_argument('-t', '--town', nargs='+', default=[TOWN], dest='town')
+    parser.add_argument('--rent', default=1035, type=float, dest='rent', help='monthly rent')
+    args = parser.parse_args()
+    rate_table(args.rate)
+    rent_eqv(args.rent)
+    grid = scenario_grid(args.income, args.dti, args.dp, args.rate, args.town)
+    for r in grid.itertuples(index=False):
+        print(_afford_string(r.income, r.dti, r.dp, r.price, r.piti, r.down_payment))
+
+if __name__ == '__main__':
+    main()
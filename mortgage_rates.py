@@ -7,49 +7,171 @@ mortgage_rates.py
 @author: david
 
 """
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
+import os
 import requests
 import pandas as pd
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import profiling
+
+TIMEOUT = 10  # seconds per request
+RETRIES = 3
+POOL_SIZE = 8
+RATE_COLUMNS = ['loan type', 'rate', 'apr', 'points']
+
+
+def default_parser():
+    """Returns the BeautifulSoup tree builder to use: MORTGAGE_HTML_PARSER, else lxml if installed"""
+    if os.environ.get('MORTGAGE_HTML_PARSER'):
+        return os.environ['MORTGAGE_HTML_PARSER']
+    return 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+
+
+PARSER = default_parser()
+
+# lender name -> (url, parser); parsers take the page soup and return a
+# DataFrame with RATE_COLUMNS
+LENDERS = {}
+
+
+def register_lender(name, url):
+    """Decorator that registers a lender page parser"""
+    def register(parser):
+        LENDERS[name] = (url, parser)
+        return parser
+    return register
+
+
+@register_lender('mandtbank', 'https://onlinemortgage.mtb.com/LoansAndRates/GetRates')
+def parse_mandtbank(site):
+    """Returns the rate table on the M&T Bank rates page"""
+    rate_dict = {}
+    counter = 0
+    tbodies = site.find_all('tbody')
+    for tbody in tbodies:
+        rows = tbody.find_all('tr')
+        for row in rows:
+            cells = row.find_all('td')
+            loan_type = str.strip(cells[0].contents[0])
+            rate = cells[1].contents[1].contents[0]
+            apr = cells[2].contents[1].contents[0]
+            points = str.strip(cells[3].contents[0])
+            rate_dict[counter] = [loan_type, rate, apr, points]
+            counter+=1
+    # convert to df
+    df = pd.DataFrame.from_dict(rate_dict, orient='index')
+    df.columns = RATE_COLUMNS
+    return df
 
 
 class Rates:
-    def __init__(self):
+    """Fetches lender rate pages over a pooled, retrying session
+
+    Args:
+        timeout (float): seconds before a request is abandoned
+        retries (int): retries on connection errors and 5xx responses
+        pool_size (int): kept-alive connections per host and fetch threads
+        base_url (str): if given, lender pages are fetched from
+            base_url/<lender> instead, e.g. from rate_fixture_server
+        parser (str): BeautifulSoup tree builder; PARSER by default
+        history: a rate_history.RateHistory every new rate table is
+            appended to
+    """
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, pool_size=POOL_SIZE, base_url=None, parser=None,
+                 history=None):
         self.var = 0
+        self.parser = parser or PARSER
+        self.history = history
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.base_url = base_url
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._validated = {}  # url -> (etag, last modified, content)
 
-    def get_website_content(self, url):
-        r = requests.get(url)
+    def lender_url(self, lender):
+        """Returns the URL the lender's page is fetched from"""
+        if self.base_url:
+            return self.base_url.rstrip('/') + '/' + lender
+        return LENDERS[lender][0]
+
+    @profiling.timed('rates.fetch')
+    def _fetch(self, url):
+        """Returns the page content and whether it changed since the last fetch (False on a 304)"""
+        headers = {}
+        cached = self._validated.get(url)
+        if cached:
+            if cached[0]:
+                headers['If-None-Match'] = cached[0]
+            if cached[1]:
+                headers['If-Modified-Since'] = cached[1]
+        r = self.session.get(url, headers=headers, timeout=self.timeout)
+        if r.status_code == 304 and cached:
+            return cached[2], False
         if r.status_code != 200:
             print('There was an error, code ' + str(r.status_code))
+        elif r.headers.get('ETag') or r.headers.get('Last-Modified'):
+            self._validated[url] = (r.headers.get('ETag'), r.headers.get('Last-Modified'), r.content)
+        return r.content, True
+
+    def fetch(self, url):
+        """Returns the page content, reusing the cached copy if it is unchanged"""
+        return self._fetch(url)[0]
 
-        soup = BeautifulSoup(r.content, "html5lib")
-        return soup
+    def fetch_all(self, urls):
+        """Returns the content of each url, fetched concurrently"""
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            return list(executor.map(self.fetch, urls))
+
+    def parse(self, content):
+        """Returns the soup of a page"""
+        with profiling.stage('rates.parse'):
+            return BeautifulSoup(content, self.parser)
+
+    def get_website_content(self, url):
+        return self.parse(self.fetch(url))
+
+    def lender_rates(self, lender):
+        """Returns the parsed rate table of a registered lender
+
+        The table is recorded in the history, if there is one, only when the
+        page has changed: an unchanged page (304) is the snapshot already there.
+        """
+        content, changed = self._fetch(self.lender_url(lender))
+        df = LENDERS[lender][1](self.parse(content))
+        if changed and self.history is not None:
+            self.history.append(lender, df)
+        return df
+
+    def collect(self, lenders=None):
+        """Returns {lender: rate table} for the lenders given, or all registered
+
+        Pages are fetched and parsed concurrently; a lender whose page cannot
+        be fetched or parsed maps to the exception raised.
+        """
+        lenders = list(LENDERS) if lenders is None else list(lenders)
+
+        def attempt(lender):
+            try:
+                return self.lender_rates(lender)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            return dict(zip(lenders, executor.map(attempt, lenders)))
 
     def rates_mandtbank(self):
         '''
         Get mortgage rates from m&t bank
         '''
         #TODO Create inner functions to get specific mortgage types
-
-        rate_dict = {}
-        counter = 0
-        url = 'https://onlinemortgage.mtb.com/LoansAndRates/GetRates'
-        site = self.get_website_content(url)
-        tbodies = site.find_all('tbody')
-        for tbody in tbodies:
-            rows = tbody.find_all('tr')
-            for row in rows:
-                cells = row.find_all('td')
-                loan_type = str.strip(cells[0].contents[0])
-                rate = cells[1].contents[1].contents[0]
-                apr = cells[2].contents[1].contents[0]
-                points = str.strip(cells[3].contents[0])
-                rate_dict[counter] = [loan_type, rate, apr, points]
-                counter+=1
-        # convert to df
-        names = ['loan type', 'rate', 'apr', 'points']
-        df = pd.DataFrame.from_dict(rate_dict, orient='index')
-        df.columns = names
-        #print(df)
+        df = self.lender_rates('mandtbank')
         # filter 30 year conventional rates
         mask_30yrcon = df['loan type'] == '30 Year Fixed Rate'
         df_30yrcon = df[mask_30yrcon]
@@ -94,5 +216,33 @@ def test():
     rates = Rates()
     rates.main()
 
+def test_offline():
+    """Runs the rate collection against the local fixture server"""
+    import shutil
+    import tempfile
+    import rate_fixture_server
+    import rate_history
+    with tempfile.TemporaryDirectory() as path:
+        shutil.copy(os.path.join(rate_fixture_server.FIXTURE_DIR, 'mandtbank.html'), path)
+        server, base_url = rate_fixture_server.start_server(fixture_dir=path)
+        try:
+            history = rate_history.RateHistory(os.path.join(path, 'history'))
+            rates = Rates(base_url=base_url, history=history)
+            rates.main()
+            df = rates.rates_mandtbank()[0]  # unchanged page: answered with 304
+            assert server.hits == 2
+            assert all(isinstance(df, pd.DataFrame) for df in rates.collect().values())
+            # the cached copies behind the 304s are not new snapshots
+            assert len(history) == len(df)
+            # a changed page is
+            with open(os.path.join(path, 'mandtbank.html'), 'a') as f:
+                f.write('<!-- updated -->')
+            rates.lender_rates('mandtbank')
+            assert server.hits == 4 and len(history) == 2 * len(df)
+            assert len(history.query('30 Year Fixed Rate', 'mandtbank', days=1)) == 2 * sum(
+                df['loan type'] == '30 Year Fixed Rate')
+        finally:
+            server.shutdown()
+
 if __name__ == "__main__":
-    test()
\ No newline at end of file
+    test()
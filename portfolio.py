@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+portfolio.py
+
+Payment figures for a whole book of loans at once. Each metric is computed
+over column arrays with the same formulas Mortgage uses, so there is no
+Python loop over loans.
+"""
+import numpy as np
+import pandas as pd
+import amortization_table as amort
+import financial as fin
+import profiling
+
+LOAN_COLUMNS = ['amount', 'price', 'rate', 'term', 'taxes', 'insurance', 'additional']
+# a level loan, then a short and a long loan with extra payments; the module tests run on these
+SAMPLE_LOANS = [(200000, 250000, 0.05, 30, 7000, 0.0035, 0),
+                (453210.55, 500000, 0.04125, 15, 9000, 0.0035, 333.33),
+                (87500, 100000, 0.0699, 40, 2500, 0.0035, 1500)]
+
+
+def loan_columns(loans, names=LOAN_COLUMNS):
+    """Returns a dict of float arrays of the named loan columns
+
+    Args:
+        loans: a DataFrame or mapping of loan columns, a Mortgage or an
+            iterable of Mortgages
+        names: the columns to return; 'additional' and 'months_paid'
+            (payments already made) are optional and default to 0, every
+            other one is required
+    """
+    if isinstance(loans, amort.Mortgage):
+        loans = [loans]
+    if not isinstance(loans, (pd.DataFrame, dict)):
+        loans = list(loans)
+        loans = {'amount': [m.amount() for m in loans], 'price': [m.price() for m in loans],
+                 'rate': [m.rate() for m in loans], 'term': [m.loan_years() for m in loans],
+                 'taxes': [m.taxes() for m in loans], 'insurance': [m._insurance for m in loans],
+                 'additional': [m.additional_pmt() for m in loans]}
+    columns = {}
+    for name in names:
+        if name in loans:
+            columns[name] = np.asarray(loans[name], dtype=float)
+        elif name in ('additional', 'months_paid'):
+            columns[name] = np.zeros_like(columns['amount'])
+        else:
+            raise KeyError('Missing loan column: ' + name)
+    return columns
+
+
+def sample_loans(**columns):
+    """Returns SAMPLE_LOANS as a DataFrame, with columns such as loan_id added or replaced"""
+    return pd.DataFrame(SAMPLE_LOANS, columns=LOAN_COLUMNS).assign(**columns)
+
+
+def mortgages(loans):
+    """Yields a Mortgage for each row of a DataFrame of loans
+
+    A first_payment column, where it has a date, sets the loan's first payment.
+    """
+    firsts = loans['first_payment'] if 'first_payment' in loans else pd.Series(None, index=loans.index)
+    for loan, first in zip(loans[LOAN_COLUMNS].itertuples(index=False), firsts):
+        yield amort.Mortgage(*loan, first_payment=None if pd.isna(first) else first)
+
+
+@profiling.timed('portfolio.metrics', rows=lambda metrics: np.size(metrics['monthly_payment']))
+def portfolio_metrics(loans, schedule=False, inflation=0.03):
+    """Returns the Mortgage payment figures for every loan as a dict of arrays
+
+    Args:
+        loans: DataFrame or mapping with the LOAN_COLUMNS columns
+        schedule (bool): also run the amortization schedules to get the
+            payoff months, total payments including the extra payment and
+            the PV of payments, as Mortgage.amortization_table reports them
+        inflation (float): annual rate the PV of payments is discounted at
+    """
+    c = loan_columns(loans)
+    months = c['term'] * amort.Mortgage.MONTHS_IN_YEAR
+    monthly = -fin.pmt(c['rate'] / amort.Mortgage.MONTHS_IN_YEAR, months, c['amount'])
+    monthly_taxes = c['taxes'] / amort.Mortgage.MONTHS_IN_YEAR
+    insurance = c['insurance'] * c['price']
+    monthly_insurance = insurance / amort.Mortgage.MONTHS_IN_YEAR
+    metrics = {'loan_months': months,
+               'monthly_payment': monthly,
+               'annual_payment': monthly * amort.Mortgage.MONTHS_IN_YEAR,
+               'total_payment': monthly * months,
+               'monthly_taxes': monthly_taxes,
+               'insurance': insurance,
+               'monthly_insurance': monthly_insurance,
+               'piti': monthly + monthly_taxes + monthly_insurance}
+    if schedule:
+        lengths, columns = amort.schedule_columns(c['amount'], c['rate'], c['term'],
+                                                  c['additional'], payment=monthly)
+        starts = np.cumsum(lengths) - lengths
+        combined = columns[1] + columns[2]
+        deflator = 1 + inflation / amort.Mortgage.MONTHS_IN_YEAR
+        discount = deflator ** (np.arange(lengths.sum()) - np.repeat(starts, lengths))
+        extra = np.add.reduceat(columns[2], starts) != 0
+        # with extra payments the PV of the original terms uses the unrounded
+        # payment, discounted from the first month
+        annuity = fin.pv(inflation / amort.Mortgage.MONTHS_IN_YEAR, months, -1, when='begin')
+        metrics['payment_months'] = lengths
+        metrics['total_combined_payment'] = np.add.reduceat(combined, starts)
+        metrics['pv_payment'] = np.where(extra, monthly * annuity, np.add.reduceat(columns[1] / discount, starts))
+        metrics['pv_combined_payment'] = np.where(extra, np.add.reduceat(combined / discount, starts),
+                                                  metrics['pv_payment'])
+    return metrics
+
+
+def portfolio_summary(loans, inflation=0.03):
+    """Returns the print_summary figures for every loan as a dict of arrays
+
+    Includes the effect of the extra payment on the term, payments and PV.
+    Loans without one, which print_summary shows no such section for, have
+    no change and no new figures (nan).
+    """
+    metrics = portfolio_metrics(loans, schedule=True, inflation=inflation)
+    # compared with the unrounded payment, the cent-rounded schedule would
+    # show a change even without an extra payment
+    extra = amort.quantize_array(loan_columns(loans)['additional']) != 0
+    months = metrics['payment_months']
+    new_monthly = np.where(extra, metrics['total_combined_payment'] / months, np.nan)
+    metrics['new_monthly_payment'] = new_monthly
+    metrics['change_months'] = np.where(extra, months - metrics['loan_months'], 0)
+    metrics['change_monthly_payment'] = np.where(extra, new_monthly - metrics['monthly_payment'], 0)
+    metrics['change_annual_payment'] = np.where(extra, new_monthly * amort.Mortgage.MONTHS_IN_YEAR
+                                                - metrics['annual_payment'], 0)
+    metrics['change_total_payment'] = np.where(extra, metrics['total_combined_payment'] - metrics['total_payment'], 0)
+    metrics['change_pv_payment'] = np.where(extra, metrics['pv_combined_payment'] - metrics['pv_payment'], 0)
+    metrics['new_piti'] = new_monthly + metrics['monthly_taxes'] + metrics['monthly_insurance']
+    return metrics
+
+
+def portfolio_table(loans, schedule=False):
+    """Returns portfolio_metrics as a DataFrame aligned with the loans"""
+    index = loans.index if isinstance(loans, pd.DataFrame) else None
+    return pd.DataFrame(portfolio_metrics(loans, schedule=schedule), index=index)
+
+
+def test():
+    """Checks portfolio_metrics against the Mortgage methods"""
+    loans = sample_loans()
+    metrics = portfolio_summary(loans)
+    for i, m in enumerate(mortgages(loans)):
+        rows = list(m.monthly_payment_schedule())
+        m.amortization_table()
+        assert np.isclose(metrics['pv_payment'][i], m._pv_payments)
+        if m._total_combined_payments:
+            assert np.isclose(metrics['pv_combined_payment'][i], m._pv_combined_payments)
+            assert np.isclose(metrics['change_total_payment'][i], m._total_combined_payments - m.total_payment())
+        assert np.isclose(metrics['monthly_payment'][i], m.monthly_payment())
+        assert np.isclose(metrics['total_payment'][i], m.total_payment())
+        assert np.isclose(metrics['piti'][i], m.piti())
+        assert metrics['payment_months'][i] == len(rows)
+        if not m.additional_pmt():
+            assert metrics['change_total_payment'][i] == metrics['change_monthly_payment'][i] == 0
+            assert np.isnan(metrics['new_piti'][i])
+        assert np.isclose(metrics['total_combined_payment'][i], sum(r[1] + r[2] for r in rows))
+    from_mortgages = loan_columns(mortgages(loans), LOAN_COLUMNS + ['months_paid'])
+    assert all(np.array_equal(from_mortgages[name], values) for name, values in loan_columns(loans).items())
+    assert not from_mortgages['months_paid'].any()
+    print('portfolio parity ok')
+
+
+if __name__ == '__main__':
+    test()
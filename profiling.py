@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+profiling.py
+
+Opt-in timing of the stages of a run. Each named stage collects its wall
+time, number of calls and rows processed. Collection is off by default,
+when an instrumented call costs a single flag check; turn it on with
+enable() or by setting MORTGAGE_PROFILE=1.
+
+A host application can read the figures with snapshot() or serve
+exposition() from a metrics endpoint. Stages are inclusive, so a stage
+that calls another also counts the inner stage's time. Figures are kept
+per process.
+"""
+import functools
+import os
+import sys
+import threading
+import time
+
+_enabled = os.environ.get('MORTGAGE_PROFILE', '') not in ('', '0')
+_stats = {}
+_lock = threading.Lock()
+
+
+def enable(on=True):
+    """Turns stage timing on or off"""
+    global _enabled
+    _enabled = bool(on)
+
+
+def enabled():
+    """Returns True if stage timing is on"""
+    return _enabled
+
+
+def reset():
+    """Clears every collected figure"""
+    with _lock:
+        _stats.clear()
+
+
+def record(name, seconds, rows=0):
+    """Adds one call of a stage"""
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = [0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += int(rows)
+
+
+class _Stage:
+    """Context manager that times one call of a stage; set rows before it exits"""
+    __slots__ = ('name', 'rows', 'start')
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start, self.rows)
+
+
+class _NullStage:
+    """Stand-in for _Stage while timing is off"""
+    __slots__ = ('rows',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, rows=0):
+    """Returns a context manager timing the named stage
+
+        with profiling.stage('table.frame') as s:
+            df = build()
+            s.rows = len(df)
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, rows)
+
+
+def timed(name, rows=None):
+    """Decorator timing every call of a function as the named stage
+
+    rows, if given, is called with the function's result to count the rows
+    it processed.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            record(name, time.perf_counter() - start, rows(result) if rows else 0)
+            return result
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    """Returns {stage: {'calls', 'seconds', 'rows'}} of the figures so far"""
+    with _lock:
+        return {name: {'calls': calls, 'seconds': seconds, 'rows': rows}
+                for name, (calls, seconds, rows) in _stats.items()}
+
+
+def exposition(prefix='mortgage_stage'):
+    """Returns the figures in the Prometheus text format"""
+    lines = []
+    for metric, key, kind in (('calls_total', 'calls', 'counter'), ('seconds_total', 'seconds', 'counter'),
+                              ('rows_total', 'rows', 'counter')):
+        lines.append('# TYPE {0}_{1} {2}'.format(prefix, metric, kind))
+        for name, stats in sorted(snapshot().items()):
+            lines.append('{0}_{1}{{stage="{2}"}} {3}'.format(prefix, metric, name, stats[key]))
+    return '\n'.join(lines) + '\n'
+
+
+def report(file=None):
+    """Prints the stages, slowest first, with calls, rows and time per call"""
+    file = file or sys.stderr
+    stats = sorted(snapshot().items(), key=lambda item: -item[1]['seconds'])
+    print('{0:<28s} {1:>8s} {2:>12s} {3:>11s} {4:>11s}'.format('Stage', 'Calls', 'Rows', 'Total ms', 'ms/call'),
+          file=file)
+    print('-' * 75, file=file)
+    for name, s in stats:
+        print('{0:<28s} {1:>8,d} {2:>12,d} {3:>11.3f} {4:>11.3f}'.format(
+            name, s['calls'], s['rows'], s['seconds'] * 1000, s['seconds'] * 1000 / s['calls']), file=file)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rate_fixture_server.py
+
+Local stand-in for the lender rate pages. Serves fixtures/rates/<lender>.html
+at /<lender> over keep-alive HTTP/1.1 with ETag and Last-Modified validators,
+so the rate fetcher can be tested and benchmarked offline.
+"""
+import argparse
+import email.utils
+import hashlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'rates')
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves lender fixtures and answers conditional requests with 304"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        name = self.path.split('?')[0].strip('/')
+        path = os.path.join(self.server.fixture_dir, name + '.html')
+        if not name or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        with open(path, 'rb') as f:
+            content = f.read()
+        etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        modified = os.path.getmtime(path)
+        last_modified = email.utils.formatdate(modified, usegmt=True)
+        since = self.headers.get('If-Modified-Since')
+        not_modified = self.headers.get('If-None-Match') == etag
+        if since and not self.headers.get('If-None-Match'):
+            since = email.utils.parsedate_to_datetime(since).timestamp()
+            not_modified = int(modified) <= since
+        self.server.hits += 1
+        if not_modified:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=0, delay=0, fixture_dir=FIXTURE_DIR):
+    """Starts the fixture server on a daemon thread
+
+    Args:
+        port (int): port to listen on; 0 picks a free one
+        delay (float): seconds to wait before answering, to mimic a slow site
+
+    Returns:
+        (server, base_url): call server.shutdown() to stop it
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), FixtureHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.fixture_dir = fixture_dir
+    server.hits = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve lender rate fixtures')
+    parser.add_argument('-p', '--port', default=8765, type=int, dest='port')
+    parser.add_argument('-d', '--delay', default=0, type=float, dest='delay')
+    args = parser.parse_args()
+    server, base_url = start_server(args.port, args.delay)
+    print('Serving {0} at {1}'.format(FIXTURE_DIR, base_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rate_history.py
+
+Append-only history of scraped lender rate tables. Every row of every
+table is kept with its lender, product, rate, APR, points and the time it
+was scraped.
+
+The history is a directory of raw column files that are only ever
+appended to, like a compact_schedule set: int64 timestamps, int32 lender
+and product codes, and float64 rate, APR and points. Lender and product
+names are dictionary-encoded in lenders.txt and products.txt, one name per
+line. Rows are appended in time order, so a time range is found with a
+binary search over the memory-mapped timestamps and only that range is
+scanned for the lender and product.
+"""
+import argparse
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+COLUMNS = [('timestamp', '<i8'), ('lender', '<i4'), ('product', '<i4'),
+           ('rate', '<f8'), ('apr', '<f8'), ('points', '<f8')]
+HISTORY_COLUMNS = [name for name, _ in COLUMNS]
+DAY = 24 * 3600
+
+
+def to_float(values):
+    """Returns rate table strings such as '4.125%' or '1,000' as floats; nan where there is no number"""
+    cleaned = pd.Series(values, dtype=object).astype(str).str.replace(r'[%$,\s]', '', regex=True)
+    return pd.to_numeric(cleaned, errors='coerce').values.astype(float)
+
+
+def _timestamp(value):
+    """Returns seconds since the epoch from a number, date string or datetime"""
+    if value is None:
+        return int(time.time())
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return int(value)
+    return int(pd.Timestamp(value).timestamp())
+
+
+class RateHistory:
+    """Append-only, columnar store of rate tables
+
+        Args:
+            path (str): directory of the history; created if needed
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._names = {kind: self._read_names(kind) for kind in ('lender', 'product')}
+        self._codes = {kind: {name: code for code, name in enumerate(names)} for kind, names in self._names.items()}
+        self._repair()
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.col')
+
+    def _read_names(self, kind):
+        """Returns the names of a dictionary-encoded column, in code order"""
+        try:
+            with open(os.path.join(self.path, kind + 's.txt')) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _encode(self, kind, names):
+        """Returns the codes of the names, adding new names to the dictionary file"""
+        codes = self._codes[kind]
+        new = [name for name in dict.fromkeys(names) if name not in codes]
+        if new:
+            with open(os.path.join(self.path, kind + 's.txt'), 'a') as f:
+                for name in new:
+                    codes[name] = len(self._names[kind])
+                    self._names[kind].append(name)
+                    f.write(name + '\n')
+        return np.array([codes[name] for name in names], dtype=np.int32)
+
+    def _sizes(self):
+        """Returns the number of rows in each column file"""
+        return [os.path.getsize(self._file(name)) // np.dtype(dtype).itemsize if os.path.exists(self._file(name))
+                else 0 for name, dtype in COLUMNS]
+
+    def _repair(self):
+        """Cuts every column back to the shortest, dropping a half-written append"""
+        rows = min(self._sizes())
+        for name, dtype in COLUMNS:
+            with open(self._file(name), 'ab') as f:
+                f.truncate(rows * np.dtype(dtype).itemsize)
+
+    def __len__(self):
+        return min(self._sizes())
+
+    def _column(self, name, dtype):
+        """Memory-maps one column file"""
+        if os.path.getsize(self._file(name)) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode='r')
+
+    def last_timestamp(self):
+        """Returns the timestamp of the newest row, or None if the history is empty"""
+        rows = len(self)
+        if not rows:
+            return None
+        return int(self._column('timestamp', '<i8')[rows - 1])
+
+    def append(self, lender, table, timestamp=None):
+        """Appends a rate table with mortgage_rates.RATE_COLUMNS, scraped at timestamp (now by default)
+
+        Timestamps must not go back in time. Returns the number of rows appended.
+        """
+        timestamp = _timestamp(timestamp)
+        with self._lock:
+            last = self.last_timestamp()
+            if last is not None and timestamp < last:
+                raise ValueError('Rate history is append-only: {0} is before the last snapshot {1}'.format(
+                    timestamp, last))
+            n = len(table)
+            values = {'timestamp': np.full(n, timestamp, dtype=np.int64),
+                      'lender': self._encode('lender', [lender] * n),
+                      'product': self._encode('product', [str(p).strip() for p in table['loan type']]),
+                      'rate': to_float(table['rate']),
+                      'apr': to_float(table['apr']),
+                      'points': to_float(table['points'])}
+            for name, dtype in COLUMNS:
+                with open(self._file(name), 'ab') as f:
+                    f.write(np.ascontiguousarray(values[name], dtype=dtype).tobytes())
+        return n
+
+    def append_collected(self, tables, timestamp=None):
+        """Appends the {lender: table} results of Rates.collect, skipping failed lenders"""
+        timestamp = _timestamp(timestamp)
+        return sum(self.append(lender, table, timestamp) for lender, table in tables.items()
+                   if isinstance(table, pd.DataFrame))
+
+    def query(self, product=None, lender=None, start=None, end=None, days=None):
+        """Returns the rows in a time range, optionally for one product and lender
+
+        Args:
+            product, lender (str): names to select; all when None
+            start, end: time range, as epoch seconds, date strings or
+                datetimes; end defaults to now
+            days (float): with no start, the range is the last days before end
+
+        Returns:
+            DataFrame with HISTORY_COLUMNS, timestamp as a UTC datetime
+        """
+        end = _timestamp(end)
+        if start is None:
+            start = end - days * DAY if days is not None else 0
+        start = _timestamp(start)
+        rows = len(self)
+        stamps = self._column('timestamp', '<i8')[:rows]
+        lo = np.searchsorted(stamps, start, side='left')
+        hi = np.searchsorted(stamps, end, side='right')
+        selected = np.ones(hi - lo, dtype=bool)
+        for kind, name in (('lender', lender), ('product', product)):
+            if name is not None:
+                code = self._codes[kind].get(name)
+                if code is None:
+                    selected[:] = False
+                else:
+                    selected &= self._column(kind, '<i4')[lo:hi] == code
+        index = np.flatnonzero(selected) + lo
+        data = {}
+        for name, dtype in COLUMNS:
+            values = self._column(name, dtype)[index]
+            if name in self._names:
+                values = pd.Categorical.from_codes(values, self._names[name])
+            data[name] = values
+        df = pd.DataFrame(data, columns=HISTORY_COLUMNS)
+        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s', utc=True)
+        return df
+
+    def best_rates(self, product, days=90, end=None):
+        """Returns the lowest rate each lender quoted for a product on each day of the range"""
+        df = self.query(product=product, days=days, end=end)
+        df = df.assign(day=df['timestamp'].dt.floor('D'))
+        return df.groupby(['day', 'lender'], observed=True)['rate'].min().unstack('lender')
+
+
+def test():
+    """Checks appends, crash repair and range queries on a temporary history"""
+    import tempfile
+    table = pd.DataFrame({'loan type': ['30 Year Fixed Rate', '30 Year Fixed Rate', 'VA 30 Year Fixed Rate'],
+                          'rate': ['4.375%', '4.125%', '4.000%'],
+                          'apr': ['4.421%', '4.262%', '4.112%'],
+                          'points': ['0.000', '1.000', '0.000']})
+    with tempfile.TemporaryDirectory() as path:
+        history = RateHistory(path)
+        day0 = _timestamp('2024-01-01')
+        for day in range(200):
+            history.append('mandtbank', table, day0 + day * DAY)
+            history.append('esl', table.iloc[:2], day0 + day * DAY + 60)
+        try:
+            history.append('esl', table, day0)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('appended a snapshot out of order')
+        # a torn append is dropped when the history is reopened
+        with open(history._file('timestamp'), 'ab') as f:
+            f.write(np.int64(day0 + 300 * DAY).tobytes())
+        history = RateHistory(path)
+        assert len(history) == 200 * 5
+        last = day0 + 199 * DAY + 60
+        df = history.query('30 Year Fixed Rate', 'esl', days=90, end=last)
+        assert len(df) == 2 * 91 and (df['lender'] == 'esl').all() and df['rate'].min() == 4.125
+        assert len(history.query('VA 30 Year Fixed Rate', start='2024-01-01', end='2024-01-10')) == 10
+        assert history.best_rates('30 Year Fixed Rate', days=9, end=last).shape == (10, 2)
+        del df
+    print('rate history ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the rate history')
+    parser.add_argument('path', help='rate history directory')
+    parser.add_argument('-p', '--product', default='30 Year Fixed Rate', dest='product')
+    parser.add_argument('-l', '--lender', default=None, dest='lender')
+    parser.add_argument('-d', '--days', default=90, type=float, dest='days')
+    args = parser.parse_args()
+    print(RateHistory(args.path).query(args.product, args.lender, days=args.days).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
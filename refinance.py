@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+refinance.py
+
+Break-even month and NPV of refinancing existing loans into candidate rate
+offers. Every loan is paired with every offer in one broadcast computation
+over (loans, offers) arrays: the balance being refinanced, the remaining
+payments and their PV come from remaining-balance formulas, so no schedule
+is run.
+
+The refinance pays off the current balance with a new loan of the offer's
+rate and term; points and closing costs are paid in cash at closing, and
+any additional payment is kept up on the new loan. The PV of payments uses
+the Mortgage.amortization_table convention: the first payment after the
+refinance is not discounted and payment m is divided by
+(1 + inflation / 12) ** m.
+"""
+import argparse
+import re
+import numpy as np
+import pandas as pd
+import amortization_table as amort
+import financial as fin
+import portfolio
+import profiling
+import rate_history
+
+LOAN_COLUMNS = ['amount', 'rate', 'term', 'additional', 'months_paid']
+OFFER_COLUMNS = ['rate', 'term', 'points', 'closing_costs']
+REFINANCE_COLUMNS = ['loan_id', 'rank', 'offer', 'rate', 'term', 'points', 'closing_costs', 'balance',
+                     'payment', 'new_payment', 'monthly_savings', 'costs', 'remaining_months', 'new_months',
+                     'break_even_month', 'npv']
+
+
+def offer_terms(offers):
+    """Returns a dict of float arrays from a DataFrame or mapping of OFFER_COLUMNS
+
+    points are percent of the refinanced balance; closing_costs is optional.
+    """
+    terms = {}
+    for name in OFFER_COLUMNS:
+        if name in offers:
+            terms[name] = np.asarray(offers[name], dtype=float)
+        elif name == 'closing_costs':
+            terms[name] = np.zeros_like(terms['rate'])
+        else:
+            raise KeyError('Missing offer column: ' + name)
+    return terms
+
+
+def offers_from_rates(table, closing_costs=0):
+    """Returns offers from a scraped rate table such as Rates.rates_mandtbank returns
+
+    The term is read from the loan type ('30 Year Fixed Rate'); rows
+    without one, such as ARMs, are left out.
+    """
+    years = table['loan type'].map(lambda name: re.search(r'(\d+)\s*Year', str(name)))
+    known = years.notna().values
+    return pd.DataFrame({'loan type': table['loan type'].values[known],
+                         'rate': rate_history.to_float(table['rate'])[known] / 100,
+                         'term': [int(match.group(1)) for match in years[known]],
+                         'points': rate_history.to_float(table['points'])[known],
+                         'closing_costs': np.broadcast_to(closing_costs, len(table))[known]})
+
+
+def _payoff(rate, payment, balance, limit):
+    """Returns the number of payments left and the final, possibly smaller, payment"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        months = np.ceil(fin.nper(rate, -payment, balance) - 1e-9)
+    months = np.where(balance > 0, np.clip(np.nan_to_num(months, nan=limit), 1, limit), 0)
+    before_last = -fin.fv(rate, np.maximum(months - 1, 0), -payment, balance)
+    return months, np.where(months > 0, np.minimum(before_last * (1 + rate), payment), 0)
+
+
+def _paid(months, payment, final, m):
+    """Returns the payments made by the end of month m of a stream"""
+    return payment * np.minimum(m, months - 1) + np.where(m >= months, final, 0)
+
+
+def _pv(months, payment, final, inflation):
+    """Returns the PV of a stream of level payments with a final payment"""
+    monthly_inflation = inflation / amort.Mortgage.MONTHS_IN_YEAR
+    level = np.maximum(months - 1, 0)
+    return (payment * fin.pv(monthly_inflation, level, -1, when='begin')
+            + np.where(months > 0, final / (1 + monthly_inflation) ** level, 0))
+
+
+@profiling.timed('refinance.grid', rows=lambda grid: grid['npv'].size)
+def refinance_grid(loans, offers, inflation=0.03, months_paid=None):
+    """Returns the refinance figures of every loan and offer as (loans, offers) arrays
+
+    Args:
+        loans: existing loans, as portfolio.loan_columns accepts; only
+            LOAN_COLUMNS are used, and months_paid defaults to 0
+        offers: candidate offers, as offer_terms accepts
+        inflation (float): annual rate the payments are discounted at
+        months_paid: payments already made on each loan, overriding any
+            months_paid column
+
+    Returns:
+        dict of arrays; break_even_month is the first month after which the
+        payments saved cover the costs, nan if they never do
+    """
+    c = portfolio.loan_columns(loans, LOAN_COLUMNS)
+    if months_paid is not None:
+        c['months_paid'] = np.broadcast_to(np.asarray(months_paid, dtype=float), c['amount'].shape)
+    o = offer_terms(offers)
+    # loans run down the rows and offers across the columns
+    rate = c['rate'][:, None] / amort.Mortgage.MONTHS_IN_YEAR
+    months = c['term'][:, None] * amort.Mortgage.MONTHS_IN_YEAR
+    additional = amort.quantize_array(c['additional'][:, None])
+    paid = c['months_paid'][:, None]
+    new_rate, new_months = o['rate'] / amort.Mortgage.MONTHS_IN_YEAR, o['term'] * amort.Mortgage.MONTHS_IN_YEAR
+    # payments are rounded up to the cent, as the amortization schedule pays them
+    payment = amort.quantize_array(-fin.pmt(rate, months, c['amount'][:, None])) + additional
+    balance = np.maximum(-fin.fv(rate, paid, -payment, c['amount'][:, None]), 0)
+    remaining, final = _payoff(rate, payment, balance, np.maximum(months - paid, 0))
+    new_payment = amort.quantize_array(-fin.pmt(new_rate, new_months, balance)) + additional
+    new_remaining, new_final = _payoff(new_rate, new_payment, balance, new_months)
+    costs = balance * o['points'] / 100 + o['closing_costs']
+
+    # saved payments rise linearly while both loans are paid, and again once
+    # only the old loan is, so the first month in each stretch is a candidate
+    savings = payment - new_payment
+    both = np.minimum(remaining, new_remaining)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        candidates = [np.clip(np.ceil(costs / savings), 1, np.maximum(both - 1, 1)), both,
+                      np.clip(np.ceil((costs + _paid(new_remaining, new_payment, new_final, new_remaining))
+                                      / payment), new_remaining + 1, np.maximum(remaining - 1, 1)),
+                      remaining]
+    shape = costs.shape
+    break_even = np.full(shape, np.inf)
+    for m in candidates:
+        m = np.nan_to_num(m, nan=np.inf, posinf=np.inf)
+        saved = _paid(remaining, payment, final, m) - _paid(new_remaining, new_payment, new_final, m)
+        break_even = np.where((saved >= costs - 1e-9) & (m >= 1) & (m < break_even), m, break_even)
+    npv = (_pv(remaining, payment, final, inflation) - _pv(new_remaining, new_payment, new_final, inflation)
+           - costs)
+    return {'balance': np.broadcast_to(balance, shape),
+            'payment': np.broadcast_to(payment, shape),
+            'new_payment': new_payment,
+            'monthly_savings': savings,
+            'costs': costs,
+            'remaining_months': np.broadcast_to(remaining, shape),
+            'new_months': new_remaining,
+            'break_even_month': np.where(np.isinf(break_even) | (balance <= 0), np.nan, break_even),
+            'npv': np.where(balance > 0, npv, np.nan)}
+
+
+def refinance_table(loans, offers, inflation=0.03, months_paid=None, top=None):
+    """Returns the offers ranked by NPV for each loan, best first
+
+    Args:
+        top (int): keep only the best offers of each loan
+
+    Returns:
+        DataFrame with REFINANCE_COLUMNS and a row per loan and offer
+    """
+    grid = refinance_grid(loans, offers, inflation, months_paid)
+    o = offer_terms(offers)
+    n_loans, n_offers = grid['npv'].shape
+    order = np.argsort(-np.nan_to_num(grid['npv'], nan=-np.inf), axis=1, kind='stable')[:, :top]
+    rows = np.repeat(np.arange(n_loans), order.shape[1])
+    cols = order.ravel()
+    if isinstance(loans, pd.DataFrame):
+        ids = loans['loan_id'].values if 'loan_id' in loans else loans.index.values
+    else:
+        ids = np.arange(n_loans)
+    offer_ids = offers.index.values if isinstance(offers, pd.DataFrame) else np.arange(n_offers)
+    data = {'loan_id': ids[rows], 'rank': np.tile(np.arange(1, order.shape[1] + 1), n_loans),
+            'offer': offer_ids[cols]}
+    data.update((name, o[name][cols]) for name in OFFER_COLUMNS)
+    data.update((name, values[rows, cols]) for name, values in grid.items())
+    return pd.DataFrame(data, columns=REFINANCE_COLUMNS)
+
+
+def test():
+    """Checks the refinance figures against amortization tables of the old and new loans"""
+    # rates above most offers', so most refinances pay off
+    loans = portfolio.sample_loans(loan_id=['a', 'b', 'c'], rate=[0.065, 0.05125, 0.0699], months_paid=[36, 100, 0])
+    offers = pd.DataFrame({'rate': [0.04375, 0.04125, 0.0375, 0.0725, 0.055],
+                           'term': [30, 30, 15, 30, 10],
+                           'points': [0, 1, 0, 0, 0.5],
+                           'closing_costs': [3000, 3000, 2500, 0, 1000]})
+    grid = refinance_grid(loans, offers)
+    for i, (loan, m) in enumerate(zip(loans.itertuples(index=False), portfolio.mortgages(loans))):
+        old = m.amortization_table()
+        start = old['Beg. Balance'].values[loan.months_paid]
+        old = (old['Monthly Payment'] + old['Additional Payment']).values[loan.months_paid:]
+        for j, offer in enumerate(offers.itertuples(index=False)):
+            balance = grid['balance'][i, j]
+            assert abs(balance - start) < 1, (i, j)
+            new = amort.Mortgage(balance, loan.price, offer.rate, offer.term, 0, 0, loan.additional)
+            new = new.amortization_table()
+            new = (new['Monthly Payment'] + new['Additional Payment']).values
+            assert (len(old), len(new)) == (grid['remaining_months'][i, j], grid['new_months'][i, j]), (i, j)
+            discount = (1 + 0.03 / amort.Mortgage.MONTHS_IN_YEAR) ** np.arange(max(len(old), len(new)))
+            npv = (old / discount[:len(old)]).sum() - (new / discount[:len(new)]).sum() - grid['costs'][i, j]
+            assert abs(npv - grid['npv'][i, j]) < 1e-4 * balance, (i, j, npv, grid['npv'][i, j])
+            n = max(len(old), len(new))
+            saved = np.cumsum(np.pad(old, (0, n - len(old)))) - np.cumsum(np.pad(new, (0, n - len(new))))
+            covered = np.flatnonzero(saved >= grid['costs'][i, j])
+            expected = covered[0] + 1 if len(covered) else np.nan
+            assert np.array_equal(expected, grid['break_even_month'][i, j], equal_nan=True), (i, j, expected)
+    same = refinance_grid(portfolio.mortgages(loans), offers, months_paid=loans['months_paid'])
+    assert np.array_equal(same['npv'], grid['npv'], equal_nan=True)
+    table = refinance_table(loans, offers, top=2)
+    assert len(table) == 6 and (table.groupby('loan_id')['npv'].diff().dropna() <= 0).all()
+    print('refinance ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank refinance offers for existing loans by NPV')
+    parser.add_argument('loan_file', help='CSV or Parquet file of loans, with an optional months_paid column')
+    parser.add_argument('offer_file', help='CSV file of offers with the rate, term, points and closing_costs columns')
+    parser.add_argument('-i', '--inflation', default=0.03, type=float, dest='inflation')
+    parser.add_argument('-n', '--top', default=3, type=int, dest='top', help='offers shown per loan')
+    parser.add_argument('-o', '--output', default=None, dest='output', help='CSV file for the results')
+    args = parser.parse_args()
+    loans = pd.read_parquet(args.loan_file) if args.loan_file.endswith('.parquet') else pd.read_csv(args.loan_file)
+    table = refinance_table(loans, pd.read_csv(args.offer_file), args.inflation, top=args.top)
+    if args.output:
+        table.to_csv(args.output, index=False)
+    else:
+        print(table.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rollups.py
+
+Per-loan, per-calendar-year totals for year-end statements: interest and
+principal paid, payments, and the taxes and insurance paid through escrow.
+Calendar years are placed from each loan's first payment date.
+
+Loans are scheduled a chunk at a time with the vectorized engine and the
+rows of each (loan, year) are summed with one segmented reduction per
+column, so no per-loan DataFrame is built. Results stream to a CSV or
+Parquet file, so memory depends on the chunk size only.
+
+Escrowed taxes come from the taxes module's town rates when the loans have
+a town column, and from the annual taxes column otherwise. Insurance
+follows the Mortgage convention of an annual rate on the price.
+"""
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+import amortization_table as amort
+import financial as fin
+import portfolio
+import profiling
+import schedule_export
+
+ROLLUP_COLUMNS = ['loan_id', 'year', 'months', 'interest', 'principal', 'additional', 'payments',
+                  'taxes', 'insurance', 'end_balance']
+
+
+def first_payment_months(chunk, first_payment=None):
+    """Returns each loan's first payment as a count of months since year 0
+
+    Uses the first_payment column where there is one and a date is given,
+    and first_payment (defaulting to the first of next month) elsewhere.
+    Dates may be in any of amort.DATE_FORMATS, mixed, as Mortgage takes them.
+    """
+    default = amort.parse_date(first_payment) if first_payment else amort.next_month_start()
+    months = np.full(len(chunk), default.year * amort.Mortgage.MONTHS_IN_YEAR + default.month - 1)
+    if 'first_payment' in chunk:
+        given = chunk['first_payment'].notna().values
+        # loans share a few dates, so parse each distinct value once
+        codes, values = pd.factorize(chunk['first_payment'][given])
+        dates = [amort.parse_date(value) for value in values]
+        months[given] = np.array([d.year * amort.Mortgage.MONTHS_IN_YEAR + d.month - 1 for d in dates],
+                                 dtype=int)[codes]
+    return months
+
+
+def annual_taxes(chunk, df=None):
+    """Returns the annual tax bill of each loan, from its town's rates when it has a known town"""
+    bills = np.asarray(chunk['taxes'], dtype=float) if 'taxes' in chunk else np.zeros(len(chunk))
+    if 'town' in chunk:
+        import taxes
+        town_bills = taxes.loan_tax_bills(chunk['price'].values, chunk['town'].values, df)
+        bills = np.where(np.isnan(town_bills), bills, town_bills)
+    return bills
+
+
+@profiling.timed('rollup.chunk', rows=len)
+def rollup_chunk(chunk, first_payment=None, tax_tables=None):
+    """Returns the yearly totals of a DataFrame chunk of loans
+
+    Args:
+        chunk: DataFrame with the portfolio.LOAN_COLUMNS columns, optionally
+            loan_id, first_payment and town; taxes may be left out when every
+            loan has a known town
+        first_payment: date for loans without a first_payment
+        tax_tables: tax tables for the town rates; the taxes module's own by default
+
+    Returns:
+        DataFrame with ROLLUP_COLUMNS and a row per loan and calendar year
+    """
+    chunk = chunk.assign(taxes=annual_taxes(chunk, tax_tables))
+    c = portfolio.loan_columns(chunk)
+    monthly = -fin.pmt(c['rate'] / amort.Mortgage.MONTHS_IN_YEAR, c['term'] * amort.Mortgage.MONTHS_IN_YEAR,
+                       c['amount'])
+    lengths, columns = amort.schedule_columns(c['amount'], c['rate'], c['term'], c['additional'], payment=monthly)
+    rows = int(lengths.sum())
+    starts = np.cumsum(lengths) - lengths
+    loan = np.repeat(np.arange(len(lengths)), lengths)
+    month = np.repeat(first_payment_months(chunk, first_payment), lengths) + np.arange(rows) - np.repeat(starts, lengths)
+    year = month // amort.Mortgage.MONTHS_IN_YEAR
+
+    # rows are ordered by loan then month, so each (loan, year) is one contiguous segment
+    boundary = np.ones(rows, dtype=bool)
+    boundary[1:] = (loan[1:] != loan[:-1]) | (year[1:] != year[:-1])
+    segments = np.flatnonzero(boundary)
+    months = np.diff(np.append(segments, rows))
+    segment_loan = loan[segments]
+    additional = np.add.reduceat(columns[2], segments)
+    ids = chunk['loan_id'].values if 'loan_id' in chunk else chunk.index.values
+    data = {'loan_id': ids[segment_loan],
+            'year': year[segments],
+            'months': months,
+            'interest': np.add.reduceat(columns[3], segments),
+            'principal': np.add.reduceat(columns[4], segments) + additional,
+            'additional': additional,
+            'payments': np.add.reduceat(columns[1] + columns[2], segments),
+            'taxes': c['taxes'][segment_loan] / amort.Mortgage.MONTHS_IN_YEAR * months,
+            'insurance': (c['insurance'][segment_loan] * c['price'][segment_loan] / amort.Mortgage.MONTHS_IN_YEAR
+                          * months),
+            'end_balance': columns[5][segments + months - 1]}
+    return pd.DataFrame(data, columns=ROLLUP_COLUMNS)
+
+
+def loan_frames(loans, chunk_size=schedule_export.CHUNK_SIZE):
+    """Yields DataFrame chunks of at most chunk_size loans from a DataFrame or an iterable of them"""
+    if isinstance(loans, pd.DataFrame):
+        loans = [loans]
+    for df in loans:
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+
+
+def annual_rollups(loans, first_payment=None, chunk_size=schedule_export.CHUNK_SIZE, tax_tables=None):
+    """Yields the yearly totals of a portfolio a chunk at a time"""
+    for chunk in loan_frames(loans, chunk_size):
+        yield rollup_chunk(chunk, first_payment, tax_tables)
+
+
+def write_rollups(loans, sink, first_payment=None, chunk_size=schedule_export.CHUNK_SIZE, file_format=None):
+    """Streams the yearly totals of a portfolio to a CSV or Parquet sink; returns the rows written"""
+    return schedule_export.write_frames(annual_rollups(loans, first_payment, chunk_size), sink, file_format)
+
+
+def test():
+    """Checks the rollups against Mortgage amortization tables grouped by year"""
+    loans = portfolio.sample_loans(loan_id=['a', 'b', 'c'], first_payment=['2018-01-01', '07/01/2019', None])
+    rollups = pd.concat(annual_rollups(loans, first_payment='2020-11-01', chunk_size=2))
+    dated = loans.fillna({'first_payment': '2020-11-01'})
+    for loan, m in zip(loans.itertuples(index=False), portfolio.mortgages(dated)):
+        table = m.amortization_table()
+        start = m.first_payment().year * amort.Mortgage.MONTHS_IN_YEAR + m.first_payment().month - 1
+        years = (start + np.arange(len(table))) // amort.Mortgage.MONTHS_IN_YEAR
+        expected = table.groupby(years).agg({'Interest': 'sum', 'Principal': 'sum', 'Additional Payment': 'sum',
+                                             'End Balance': 'last', 'Monthly Payment': 'size'})
+        got = rollups[rollups['loan_id'] == loan.loan_id].set_index('year')
+        assert np.allclose(got['interest'], expected['Interest']), loan
+        assert np.allclose(got['principal'], expected['Principal'] + expected['Additional Payment']), loan
+        assert np.allclose(got['end_balance'], expected['End Balance']), loan
+        assert np.allclose(got['taxes'], m.monthly_taxes() * expected['Monthly Payment']), loan
+        assert np.allclose(got['insurance'], m.monthly_insurance() * expected['Monthly Payment']), loan
+    print('rollups ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Yearly interest, principal, tax and insurance totals per loan')
+    parser.add_argument('loan_file', help='CSV or Parquet file of loans')
+    parser.add_argument('-o', '--output', default=None, dest='output',
+                        help='.csv or .parquet file for the results; CSV to stdout if omitted')
+    parser.add_argument('-d', '--first-payment', default=None, dest='first_payment',
+                        help='first payment date of loans without a first_payment column value')
+    parser.add_argument('--chunk-size', default=schedule_export.CHUNK_SIZE, type=int, dest='chunk_size')
+    args = parser.parse_args()
+    loans = schedule_export.read_loan_file(args.loan_file, args.chunk_size)
+    write_rollups(loans, args.output or sys.stdout, args.first_payment, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+scenarios.py
+
+Monte Carlo scenarios for interest rate and inflation paths. Fixed-rate and
+adjustable-rate loans are run against simulated paths to get the
+distribution of total payments and of the PV of payments, using the same
+monthly discounting convention as Mortgage.amortization_table.
+
+Paths are simulated in fixed-size chunks, each with its own seed spawned
+from one SeedSequence, and the chunks are spread over a process pool. The
+results for a seed do not depend on the number of workers.
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import amortization_table as amort
+import financial as fin
+import portfolio
+
+CHUNK_SIZE = 2500
+
+
+class MeanReverting:
+    """Mean-reverting (Vasicek) model of an annual rate, stepped monthly
+
+        Args:
+            start (float): rate at month 0
+            mean (float): long-run rate the paths revert to
+            reversion (float): speed of reversion per year
+            volatility (float): annual standard deviation of rate changes
+            floor (float): lowest rate a path may take
+    """
+    def __init__(self, start, mean, reversion=0.2, volatility=0.01, floor=0.0):
+        self.start = start
+        self.mean = mean
+        self.reversion = reversion
+        self.volatility = volatility
+        self.floor = floor
+
+    def paths(self, rng, n_paths, months):
+        """Returns an (n_paths, months) array of annual rates"""
+        dt = 1.0 / amort.Mortgage.MONTHS_IN_YEAR
+        shocks = rng.standard_normal((n_paths, months)) * self.volatility * np.sqrt(dt)
+        rates = np.empty((n_paths, months))
+        rate = np.full(n_paths, float(self.start))
+        for month in range(months):
+            rates[:, month] = rate
+            rate = np.maximum(rate + self.reversion * (self.mean - rate) * dt + shocks[:, month], self.floor)
+        return rates
+
+
+class ARM:
+    """Terms of an adjustable-rate loan
+
+        Args:
+            margin (float): spread added to the index at each reset
+            fixed_months (int): months at the initial rate, e.g. 60 for a 5/1
+            reset_months (int): months between later resets
+            initial_cap (float): largest change at the first reset
+            periodic_cap (float): largest change at each later reset
+            lifetime_cap (float): largest rise over the initial rate
+            floor (float): lowest rate; defaults to the margin
+    """
+    def __init__(self, margin=0.0275, fixed_months=60, reset_months=12, initial_cap=0.02,
+                 periodic_cap=0.02, lifetime_cap=0.05, floor=None):
+        self.margin = margin
+        self.fixed_months = fixed_months
+        self.reset_months = reset_months
+        self.initial_cap = initial_cap
+        self.periodic_cap = periodic_cap
+        self.lifetime_cap = lifetime_cap
+        self.floor = margin if floor is None else floor
+
+    def periods(self, months):
+        """Returns the (start, end) months of each rate period"""
+        starts = [0] + list(range(self.fixed_months, months, self.reset_months))
+        return list(zip(starts, starts[1:] + [months]))
+
+    def reset(self, rate, initial, index, first):
+        """Returns the rate after a reset, given the index on the reset date"""
+        cap = self.initial_cap if first else self.periodic_cap
+        rate = np.clip(index + self.margin, rate - cap, rate + cap)
+        return np.clip(rate, self.floor, initial + self.lifetime_cap)
+
+
+def _discount_sums(inflation):
+    """Returns the discount factors and their running sums of reciprocals
+
+    The payment in month m (from 0) is divided by the compounded monthly
+    inflation of the months before it, as in Mortgage.amortization_table.
+    sums[:, m] is the PV of paying 1 in each of the first m months.
+    """
+    growth = 1.0 + inflation / amort.Mortgage.MONTHS_IN_YEAR
+    factors = np.ones_like(growth)
+    factors[:, 1:] = np.cumprod(growth[:, :-1], axis=1)
+    sums = np.zeros((growth.shape[0], growth.shape[1] + 1))
+    np.cumsum(1.0 / factors, axis=1, out=sums[:, 1:])
+    return factors, sums
+
+
+def simulate_loan(amount, rate, term, additional, index, inflation, arm=None):
+    """Returns the total payments and PV of payments of one loan on every path
+
+    Between resets the rate is constant, so each period is evaluated with
+    the closed-form annuity, vectorized over the paths. At each reset the
+    payment is re-amortized over the remaining term.
+
+    Args:
+        amount, rate, term, additional: loan terms as passed to Mortgage
+        index (array): (paths, months) annual index rates, used by ARMs
+        inflation (array): (paths, months) annual inflation rates
+        arm (ARM): adjustable-rate terms, or None for a fixed rate
+    """
+    months = int(term * amort.Mortgage.MONTHS_IN_YEAR)
+    n_paths = inflation.shape[0]
+    factors, sums = _discount_sums(inflation[:, :months])
+    paths = np.arange(n_paths)
+    balance = np.full(n_paths, float(amount))
+    current = np.full(n_paths, float(rate))
+    total = np.zeros(n_paths)
+    pv = np.zeros(n_paths)
+    open_ = np.ones(n_paths, dtype=bool)
+    periods = arm.periods(months) if arm is not None else [(0, months)]
+    for number, (start, end) in enumerate(periods):
+        if number:
+            current = arm.reset(current, rate, index[:, start], number == 1)
+        monthly = current / amort.Mortgage.MONTHS_IN_YEAR
+        growth = 1.0 + monthly
+        remaining = months - start
+        payment = -fin.pmt(monthly, remaining, balance) + additional
+        # months until the balance is gone at this payment
+        payoff = fin.nper(monthly, -payment, balance)
+        length = end - start
+        payoff = np.where(np.isnan(payoff), np.inf, payoff)
+        ends = open_ & (np.ceil(payoff - 1e-9) <= length)
+        full = np.where(ends, np.ceil(payoff - 1e-9) - 1, length).astype(int)
+        left = -fin.fv(monthly, full, -payment, balance)
+        # regular payments of this period
+        paid = np.where(open_, payment * full, 0.0)
+        paid_pv = np.where(open_, payment * (sums[paths, start + full] - sums[:, start]), 0.0)
+        # final, partial payment on the paths that pay off in this period
+        last = np.where(ends, left * growth, 0.0)
+        last_month = np.minimum(start + full, months - 1)
+        total += paid + last
+        pv += paid_pv + last / factors[paths, last_month]
+        balance = np.where(ends, 0.0, left)
+        open_ &= ~ends
+    return total, pv
+
+
+def _simulate_chunk(terms, n_paths, seed, index_model, inflation_model, arm):
+    """Simulates one chunk of paths for every loan; runs in a worker process"""
+    amount, rate, term, additional = terms
+    months = int(term.max() * amort.Mortgage.MONTHS_IN_YEAR)
+    rng = np.random.default_rng(seed)
+    index = index_model.paths(rng, n_paths, months)
+    inflation = inflation_model.paths(rng, n_paths, months)
+    total = np.empty((amount.shape[0], n_paths))
+    pv = np.empty((amount.shape[0], n_paths))
+    for i in range(amount.shape[0]):
+        total[i], pv[i] = simulate_loan(amount[i], rate[i], term[i], additional[i], index, inflation, arm)
+    return total, pv
+
+
+def run_scenarios(loans, n_paths=10000, index_model=None, inflation_model=None, arm=None,
+                  seed=0, workers=None, chunk_size=CHUNK_SIZE):
+    """Runs every loan against n_paths simulated rate and inflation paths
+
+    Args:
+        loans: Mortgage objects, or a DataFrame/mapping of portfolio columns
+        index_model, inflation_model (MeanReverting): path models; default to
+            a 5% index and the 3% inflation Mortgage assumes
+        arm (ARM): adjustable-rate terms applied to every loan, or None
+        seed (int): root seed; each chunk of paths gets a spawned child seed
+        workers (int): processes to use; defaults to the CPU count, and 1
+            runs in this process
+
+    Returns:
+        dict with 'total_payment' and 'pv_payment' arrays of shape (loans, paths)
+    """
+    c = portfolio.loan_columns(loans, ['amount', 'rate', 'term', 'additional'])
+    terms = c['amount'], c['rate'], c['term'], c['additional']
+    index_model = index_model or MeanReverting(0.05, 0.05)
+    inflation_model = inflation_model or MeanReverting(0.03, 0.03, volatility=0.005)
+    sizes = [min(chunk_size, n_paths - start) for start in range(0, n_paths, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(terms, size, child, index_model, inflation_model, arm) for size, child in zip(sizes, seeds)]
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(jobs) == 1:
+        results = [_simulate_chunk(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            results = list(executor.map(_simulate_chunk, *zip(*jobs)))
+    return {'total_payment': np.concatenate([r[0] for r in results], axis=1),
+            'pv_payment': np.concatenate([r[1] for r in results], axis=1)}
+
+
+def summarize(results, percentiles=(5, 50, 95)):
+    """Returns the mean, standard deviation and percentiles of each result per loan"""
+    rows = {}
+    for name, values in results.items():
+        rows[(name, 'mean')] = values.mean(axis=1)
+        rows[(name, 'std')] = values.std(axis=1)
+        for p, v in zip(percentiles, np.percentile(values, percentiles, axis=1)):
+            rows[(name, 'p{0}'.format(p))] = v
+    return pd.DataFrame(rows)
+
+
+def test():
+    """Checks constant paths against Mortgage and that results do not depend on the worker count"""
+    samples = portfolio.sample_loans()
+    loans = list(portfolio.mortgages(samples)) + list(portfolio.mortgages(samples.assign(additional=0)))
+    flat = MeanReverting(0.05, 0.05, volatility=0.0)
+    inflation = MeanReverting(0.03, 0.03, volatility=0.0)
+    # with no volatility every path is the fixed-rate loan
+    fixed = run_scenarios(loans, 4, flat, inflation, workers=1)
+    for i, m in enumerate(loans):
+        assert np.allclose(fixed['total_payment'][i], m.total_interest() + m.amount()), i
+    # an ARM whose index plus margin stays at the initial rate is the fixed-rate
+    # loan; with extra payments a reset would recast a smaller payment instead
+    arm = ARM(margin=0.0275)
+    for i, m in enumerate(loans):
+        if m.additional_pmt():
+            continue
+        index = MeanReverting(m.rate() - arm.margin, m.rate() - arm.margin, volatility=0.0)
+        adjustable = run_scenarios([m], 4, index, inflation, arm=arm, workers=1)
+        assert np.allclose(adjustable['total_payment'], fixed['total_payment'][i]), i
+        assert np.allclose(adjustable['pv_payment'], fixed['pv_payment'][i]), i
+    # each chunk has its own seed, so the paths do not depend on the workers
+    one = run_scenarios(loans, 1000, arm=ARM(), seed=7, workers=1, chunk_size=250)
+    three = run_scenarios(loans, 1000, arm=ARM(), seed=7, workers=3, chunk_size=250)
+    assert all(np.array_equal(one[k], three[k]) for k in one)
+    print('scenarios ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mortgage rate scenarios')
+    parser.add_argument('-r', '--interest', default=5, type=float, dest='interest')
+    parser.add_argument('-y', '--loan-years', default=30, type=int, dest='years')
+    parser.add_argument('-a', '--amount', default=200000, type=float, dest='amount')
+    parser.add_argument('-e', '--extra-payment', default=0, type=float, dest='extra')
+    parser.add_argument('-n', '--paths', default=10000, type=int, dest='paths')
+    parser.add_argument('-w', '--workers', default=None, type=int, dest='workers')
+    parser.add_argument('-s', '--seed', default=0, type=int, dest='seed')
+    parser.add_argument('--arm', default=None, type=int, dest='arm',
+                        help='fixed years of an adjustable-rate loan, e.g. 5 for a 5/1 ARM')
+    args = parser.parse_args()
+    loans = {'amount': [args.amount], 'price': [args.amount], 'rate': [args.interest / 100],
+             'term': [args.years], 'taxes': [0], 'insurance': [0], 'additional': [args.extra]}
+    arm = ARM(fixed_months=args.arm * amort.Mortgage.MONTHS_IN_YEAR) if args.arm else None
+    results = run_scenarios(loans, args.paths, arm=arm, seed=args.seed, workers=args.workers)
+    print(summarize(results).T)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+schedule_export.py
+
+Streams amortization schedules for a whole portfolio to a CSV or Parquet
+file. Loans are processed in chunks through the vectorized schedule engine,
+so memory use depends on the chunk size, not on the size of the portfolio.
+Parquet output needs pyarrow.
+"""
+import os
+import numpy as np
+import pandas as pd
+import amortization_table as amort
+import profiling
+
+CHUNK_SIZE = 10000
+EXPORT_COLUMNS = ['Loan ID', 'Month'] + amort.SCHEDULE_COLUMNS
+
+
+def read_loan_file(path, chunk_size=CHUNK_SIZE):
+    """Yields DataFrame chunks of a CSV or Parquet loan file
+
+    Chunks are indexed by row number in the file, so the index can stand in
+    for a missing loan_id column. A blank additional cell is no extra payment.
+    """
+    if str(path).endswith(('.parquet', '.pq')):
+        import pyarrow.parquet as pq
+        start = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            # every batch comes with its own index from 0, unlike read_csv chunks
+            df = batch.to_pandas()
+            df.index = pd.RangeIndex(start, start + len(df))
+            start += len(df)
+            yield _fill_blanks(df)
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunk_size):
+            yield _fill_blanks(chunk)
+
+
+def _fill_blanks(df):
+    """Returns a chunk of a loan file with blank additional payments set to 0"""
+    if 'additional' in df:
+        df['additional'] = df['additional'].fillna(0)
+    return df
+
+
+def _mortgage_chunk(mortgages, ids):
+    """Returns the loan columns of a list of Mortgage objects"""
+    return {'loan_id': np.asarray(ids),
+            'amount': np.array([m.amount() for m in mortgages], dtype=float),
+            'rate': np.array([m.rate() for m in mortgages], dtype=float),
+            'term': np.array([m.loan_years() for m in mortgages], dtype=int),
+            'additional': np.array([m.additional_pmt() for m in mortgages], dtype=float),
+            'payment': np.array([m.monthly_payment() for m in mortgages], dtype=float)}
+
+
+def _frame_chunk(df):
+    """Returns the loan columns of a DataFrame of loans"""
+    ids = df['loan_id'].values if 'loan_id' in df else df.index.values
+    additional = df['additional'].values if 'additional' in df else 0.0
+    return {'loan_id': ids,
+            'amount': df['amount'].values,
+            'rate': df['rate'].values,
+            'term': df['term'].values,
+            'additional': np.broadcast_to(additional, len(df)),
+            'payment': None}
+
+
+def loan_chunks(loans, chunk_size=CHUNK_SIZE):
+    """Yields dicts of loan columns, at most chunk_size loans each
+
+    Args:
+        loans: a DataFrame, or an iterable of Mortgage objects, loan mappings
+            (with amount, rate, term and optionally additional and loan_id)
+            or DataFrame chunks
+    """
+    if isinstance(loans, pd.DataFrame):
+        loans = [loans]
+    mortgages = []
+    ids = []
+    count = 0
+    for loan in loans:
+        if isinstance(loan, pd.DataFrame):
+            if mortgages:
+                yield _mortgage_chunk(mortgages, ids)
+                mortgages, ids = [], []
+            for start in range(0, len(loan), chunk_size):
+                yield _frame_chunk(loan.iloc[start:start + chunk_size])
+            count += len(loan)
+            continue
+        if hasattr(loan, 'monthly_payment'):  # a Mortgage
+            ids.append(count)
+        else:
+            ids.append(loan.get('loan_id', count))
+            loan = amort.Mortgage(loan['amount'], loan.get('price', 0), loan['rate'], loan['term'],
+                                  loan.get('taxes', 0), loan.get('insurance', 0), loan.get('additional', 0))
+        mortgages.append(loan)
+        count += 1
+        if len(mortgages) == chunk_size:
+            yield _mortgage_chunk(mortgages, ids)
+            mortgages, ids = [], []
+    if mortgages:
+        yield _mortgage_chunk(mortgages, ids)
+
+
+@profiling.timed('export.frame', rows=len)
+def schedule_frame(chunk):
+    """Returns the schedules of a chunk of loans as one long DataFrame"""
+    lengths, columns = amort.schedule_columns(chunk['amount'], chunk['rate'], chunk['term'],
+                                              chunk['additional'], payment=chunk['payment'])
+    starts = np.cumsum(lengths) - lengths
+    months = np.arange(lengths.sum()) - np.repeat(starts, lengths) + 1
+    data = {'Loan ID': np.repeat(chunk['loan_id'], lengths), 'Month': months}
+    data.update(zip(amort.SCHEDULE_COLUMNS, columns))
+    return pd.DataFrame(data, columns=EXPORT_COLUMNS)
+
+
+def sink_format(sink, file_format=None):
+    """Returns 'csv' or 'parquet' for a sink, from the file extension if not given"""
+    if file_format is None:
+        file_format = 'parquet' if str(sink).endswith(('.parquet', '.pq')) else 'csv'
+    if file_format not in ('csv', 'parquet'):
+        raise ValueError('Unknown export format: ' + str(file_format))
+    return file_format
+
+
+def write_frames(frames, sink, file_format=None):
+    """Appends a stream of DataFrames with the same columns to one CSV or Parquet sink
+
+    Args:
+        frames: iterable of DataFrames, written as they arrive
+        sink: output path, or a writable text file for CSV
+        file_format (str): 'csv' or 'parquet'; taken from the file extension
+            when not given
+
+    Returns:
+        int: number of rows written
+    """
+    file_format = sink_format(sink, file_format)
+    rows = 0
+    writer = None
+    handle = open(sink, 'w', newline='') if isinstance(sink, (str, os.PathLike)) and file_format == 'csv' else sink
+    try:
+        for df in frames:
+            with profiling.stage('export.' + file_format, rows=len(df)):
+                if file_format == 'csv':
+                    df.to_csv(handle, header=rows == 0, index=False)
+                else:
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(sink, table.schema)
+                    writer.write_table(table)
+            rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+        if handle is not sink:
+            handle.close()
+    return rows
+
+
+def export_schedules(loans, sink, file_format=None, chunk_size=CHUNK_SIZE):
+    """Writes the amortization schedules of many loans to a CSV or Parquet sink
+
+    Args:
+        loans: anything loan_chunks accepts
+        sink: output path, or a writable text file for CSV
+        file_format (str): 'csv' or 'parquet'; taken from the file extension
+            when not given
+        chunk_size (int): number of loans scheduled and written at a time
+
+    Returns:
+        int: number of schedule rows written
+    """
+    frames = (schedule_frame(chunk) for chunk in loan_chunks(loans, chunk_size))
+    return write_frames(frames, sink, file_format)
+
+
+def test():
+    """Checks an exported CSV across chunk boundaries against the decimal_payment_schedule reference"""
+    import tempfile
+    import portfolio
+    loans = portfolio.sample_loans(loan_id=['a', 'b', 'c'])
+    mortgages = list(portfolio.mortgages(loans))
+    with tempfile.TemporaryDirectory() as path:
+        sink = os.path.join(path, 'schedules.csv')
+        # two loans per chunk, so the last loan is written by the second chunk
+        for source in (loans, mortgages):
+            rows = export_schedules(source, sink, chunk_size=2)
+            df = pd.read_csv(sink)
+            assert rows == len(df) and list(df.columns) == EXPORT_COLUMNS
+            ids = loans['loan_id'] if source is loans else range(len(mortgages))
+            for loan_id, m in zip(ids, mortgages):
+                schedule = df[df['Loan ID'].astype(str) == str(loan_id)]
+                reference = list(m.decimal_payment_schedule())
+                assert list(schedule['Month']) == list(range(1, len(reference) + 1)), loan_id
+                assert np.allclose(schedule[amort.SCHEDULE_COLUMNS].values, reference, rtol=0, atol=0.005), loan_id
+        sink = os.path.join(path, 'schedule.csv')
+        mortgages[1].amort_table_to_csv(sink)
+        assert len(pd.read_csv(sink)) == len(list(mortgages[1].decimal_payment_schedule()))
+    print('schedule export ok')
+
+
+if __name__ == '__main__':
+    test()
@@ -9,11 +9,85 @@ Calculate taxes for a given house value by town
 @author: david
 """
 
+import os
+import time
+import numpy as np
 import pandas as pd
+import profiling
 from taxes_dict import tax_dict
 
 _URL = 'https://www2.monroecounty.gov/property-taxrates.php'
-_DF = pd.read_html(_URL, header=0)
+# the tax tables are fetched on first use and kept in a local snapshot;
+# set MORTGAGE_TAX_SOURCE to a saved copy of the page (or a snapshot) to run offline
+TAX_SOURCE = os.environ.get('MORTGAGE_TAX_SOURCE', _URL)
+SNAPSHOT_PATH = os.environ.get('MORTGAGE_TAX_SNAPSHOT',
+                               os.path.join(os.path.expanduser('~'), '.cache', 'mortgage', 'property_taxrates.pkl'))
+SNAPSHOT_TTL = float(os.environ.get('MORTGAGE_TAX_TTL', 7 * 24 * 3600))  # seconds
+SCHOOL_ASSESSMENT = 0.90  # school taxes are assessed against 90% of house value
+INDEX_COLUMNS = ['ad_valorem', 'school', 'flat']
+_TABLES = None
+_INDEX = None
+
+
+def _is_snapshot(path):
+    """Returns True if the path names a pickled table snapshot"""
+    return str(path).endswith('.pkl')
+
+
+@profiling.timed('taxes.read_source')
+def read_tax_source(source=TAX_SOURCE):
+    """Returns the county/town, special district and school/library tables
+
+    source can be the county web page, a saved copy of it or a snapshot file.
+    """
+    if _is_snapshot(source):
+        return pd.read_pickle(source)
+    return pd.read_html(source, header=0)[:3]
+
+
+def save_snapshot(tables, path=SNAPSHOT_PATH):
+    """Writes the tax tables to a snapshot file"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    pd.to_pickle(list(tables), tmp)
+    os.replace(tmp, path)
+
+
+def load_tax_tables(source=TAX_SOURCE, snapshot=SNAPSHOT_PATH, ttl=SNAPSHOT_TTL, refresh=False):
+    """Loads the tax tables, preferring a snapshot younger than ttl seconds
+
+    A stale snapshot is refreshed from source; if source cannot be read the
+    stale snapshot is used rather than failing. Pass snapshot=None to skip the
+    snapshot entirely and ttl=None for a snapshot that never expires.
+    """
+    global _TABLES
+    age = None
+    if snapshot and os.path.exists(snapshot):
+        age = time.time() - os.path.getmtime(snapshot)
+    if age is not None and not refresh and (ttl is None or age < ttl):
+        with profiling.stage('taxes.snapshot'):
+            _TABLES = pd.read_pickle(snapshot)
+        return _TABLES
+    try:
+        tables = read_tax_source(source)
+    except Exception:
+        if age is None:
+            raise
+        tables = pd.read_pickle(snapshot)
+    else:
+        if snapshot and source != snapshot:
+            save_snapshot(tables, snapshot)
+    _TABLES = tables
+    return _TABLES
+
+
+def tax_tables():
+    """Returns the tax tables, loading them on first use"""
+    if _TABLES is None:
+        load_tax_tables()
+    return _TABLES
 
 def tax_county_town(df, town):
     """Returns county and town tax rates per $1,000 of value"""
@@ -30,7 +104,7 @@ def tax_school_library(df, town, school):
     df = df[2]
     town = str(town).title()
     school = str(school).title()
-    df = df.fillna(method='ffill')
+    df = df.ffill()
     df_school = df['Town'] == school
     df_town = df['District'] == town
     return df[df_school & df_town].head(1)['Total'].values[0]
@@ -54,65 +128,166 @@ def tax_special(df, districts, price_000):
 
     return tax_dollars
 
-def tax_calc(df=_DF, price=200000, municipality='Fairport', town='Perinton', school='Fairport (Village)', school_town='Fairport', districts=['PR104','PR110','PR701-B']):
-    """Returns string with the tax bill and tax % given the price and home location"""
-    price_000 = price / 1000
-    total_taxes = 0
-    # calc the different types of taxes
+def special_rates(df, districts):
+    """Returns the special district rate per $1,000 and the flat $ charges"""
+    df = df[1]
+    per_1000 = 0
+    flat = 0
+    for district in districts:
+        d = df[df['Code'] == district]
+        if d['Unnamed: 8'].values[0] == '/1000':
+            per_1000 += d['Tax Rate'].values[0]
+        elif d['Unnamed: 8'].values[0] == '/ Unit':
+            flat += d['Tax Rate'].values[0]
+    return per_1000, flat
+
+def compile_location(df, town, school, school_town, districts):
+    """Returns the ad valorem and school rates per $1,000 and the flat $ charges of a location"""
     c, t = tax_county_town(df, town)
-    total_taxes += (c * price_000 + t * price_000)
     s = tax_school_library(df, school_town, school)
-    total_taxes += (s * price_000 * 0.90) #assessed against 90% of house value
-    d = tax_special(df, districts, price_000)
-    for tax in d:
-        total_taxes += tax
+    per_1000, flat = special_rates(df, districts)
+    return c + t + per_1000, s, flat
 
-    return (municipality + ' Taxes: ${0:,.0f}  {1:.1f}%'.format(total_taxes, total_taxes / price * 100))
+def tax_index(df=None):
+    """Returns the compiled rates of every municipality in tax_dict
 
-def tax_rate(df=_DF, price=200000, municipality='Fairport', town='Perinton', school='Fairport (Village)', school_town='Fairport', districts=['PR104','PR110','PR701-B']):
-    """Returns tax rate given the price and home location"""
-    price_000 = price / 1000
-    total_taxes = 0
-    # calc the different types of taxes
-    c, t = tax_county_town(df, town)
-    total_taxes += (c * price_000 + t * price_000)
-    s = tax_school_library(df, school_town, school)
-    total_taxes += (s * price_000 * 0.90) #assessed against 90% of house value
-    d = tax_special(df, districts, price_000)
-    for tax in d:
-        total_taxes += tax
-
-    return total_taxes / price
-
-def get_all_town_taxes():
-    """Calls tax_calc on each town in tax_dict"""
-    town_taxes = []
-    for k,v in tax_dict.items():
-        price = 200000
-        municipality = k
-        town = v['town']
-        school = v['school']
-        school_town = v['school_town']
-        districts = v['districts']
-        town_taxes.append(tax_calc(_DF, price=price, municipality=municipality, town=town, school=school, school_town=school_town, districts=districts))
-    return town_taxes
+    The tables are scanned once per set of tables; every later lookup is a
+    row of this small DataFrame.
+    """
+    global _INDEX
+    if df is None:
+        df = tax_tables()
+    if _INDEX is None or _INDEX[0] is not df:
+        with profiling.stage('taxes.index', rows=len(tax_dict)):
+            rates = {k: compile_location(df, v['town'], v['school'], v['school_town'], v['districts'])
+                     for k, v in tax_dict.items()}
+        _INDEX = (df, pd.DataFrame.from_dict(rates, orient='index', columns=INDEX_COLUMNS))
+    return _INDEX[1]
+
+def _tax_bill(ad_valorem, school, flat, price):
+    """Returns the annual tax bill in $ from compiled rates"""
+    price_000 = np.asarray(price, dtype=float) / 1000
+    return price_000 * (ad_valorem + school * SCHOOL_ASSESSMENT) + flat
+
+def _tax_string(municipality, total_taxes, price):
+    """Formats a tax bill the way tax_calc reports it"""
+    return municipality + ' Taxes: ${0:,.0f}  {1:.1f}%'.format(total_taxes, total_taxes / price * 100)
+
+def town_tax_bills(prices, towns=None, df=None):
+    """Returns the annual tax bills with a row per town and a column per price"""
+    index = tax_index(df)
+    if towns is not None:
+        index = index.loc[list(towns)]
+    prices = np.atleast_1d(np.asarray(prices, dtype=float))
+    bills = _tax_bill(index['ad_valorem'].values[:, None], index['school'].values[:, None],
+                      index['flat'].values[:, None], prices)
+    return pd.DataFrame(bills, index=index.index, columns=prices)
+
+def loan_tax_terms(towns, df=None):
+    """Returns the annual tax per $ of price and the flat $ charges of each town
+
+    A house's tax bill is price * per_dollar + flat; both are nan for a town
+    that is not in tax_dict.
+    """
+    index = tax_index(df).reindex(list(towns))
+    return _tax_bill(index['ad_valorem'].values, index['school'].values, 0, 1), index['flat'].values
+
+def loan_tax_bills(prices, towns, df=None):
+    """Returns the annual tax bill of each house from its own price and town
+
+    nan for a town that is not in tax_dict.
+    """
+    per_dollar, flat = loan_tax_terms(towns, df)
+    return np.asarray(prices, dtype=float) * per_dollar + flat
+
+def town_tax_rates(prices, towns=None, df=None):
+    """Returns tax_rate with a row per town and a column per price"""
+    bills = town_tax_bills(prices, towns, df)
+    return bills / bills.columns.values
+
+def tax_calc(df=None, price=200000, municipality='Fairport', town='Perinton', school='Fairport (Village)', school_town='Fairport', districts=['PR104','PR110','PR701-B']):
+    """Returns string with the tax bill and tax % given the price and home location"""
+    if df is None:
+        df = tax_tables()
+    total_taxes = _tax_bill(*compile_location(df, town, school, school_town, districts), price)
+    return _tax_string(municipality, total_taxes, price)
+
+def tax_rate(df=None, price=200000, municipality='Fairport', town='Perinton', school='Fairport (Village)', school_town='Fairport', districts=['PR104','PR110','PR701-B']):
+    """Returns tax rate given the price (or an array of prices) and home location"""
+    if df is None:
+        df = tax_tables()
+    return _tax_bill(*compile_location(df, town, school, school_town, districts), price) / price
+
+def get_all_town_taxes(price=200000):
+    """Returns the tax_calc string of each town in tax_dict"""
+    bills = town_tax_bills(price)[float(price)]
+    return [_tax_string(municipality, total_taxes, price) for municipality, total_taxes in bills.items()]
 
 def get_town_tax(town_name='Fairport'):
-    """Calls tax_calc on the town given"""
-    v = tax_dict[town_name]
-    municipality = town_name
-    town = v['town']
-    school = v['school']
-    school_town = v['school_town']
-    districts = v['districts']
-    return tax_calc(_DF, price=200000, municipality=municipality, town=town, school=school, school_town=school_town, districts=districts)
+    """Returns the tax_calc string of the town given"""
+    price = 200000
+    return _tax_string(town_name, _tax_bill(*tax_index().loc[town_name], price), price)
 
 def get_town_tax_rate(town_name='Fairport', price=200000):
-    """Calls tax_rate on the town given"""
-    v = tax_dict[town_name]
-    municipality = town_name
-    town = v['town']
-    school = v['school']
-    school_town = v['school_town']
-    districts = v['districts']
-    return tax_rate(_DF, price=price, municipality=municipality, town=town, school=school, school_town=school_town, districts=districts)
+    """Returns the tax rate of the town given at a price or an array of prices"""
+    return _tax_bill(*tax_index().loc[town_name], price) / np.asarray(price, dtype=float)
+
+def _scan_tax_bill(df, location, price):
+    """Returns a tax bill by scanning the tables for every part, as tax_calc first did"""
+    price_000 = price / 1000
+    c, t = tax_county_town(df, location['town'])
+    s = tax_school_library(df, location['school_town'], location['school'])
+    return c * price_000 + t * price_000 + s * price_000 * 0.90 + sum(tax_special(df, location['districts'], price_000))
+
+def test():
+    """Checks the compiled index against table scans, and the snapshot fallbacks, on the fixture tables"""
+    import json
+    import tempfile
+    global tax_dict, _TABLES, _INDEX
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'taxes')
+    source = os.path.join(fixtures, 'property_taxrates.html')
+    with open(os.path.join(fixtures, 'towns.json')) as f:
+        towns = json.load(f)
+    saved = tax_dict, _TABLES, _INDEX
+    tax_dict, _INDEX = towns, None
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            snapshot = os.path.join(path, 'taxes.pkl')
+            missing = os.path.join(path, 'missing.html')
+            df = load_tax_tables(source, snapshot)
+            assert os.path.exists(snapshot)
+            # a fresh snapshot is read without fetching the source again
+            recent = time.time() - 60
+            os.utime(snapshot, (recent, recent))
+            assert all(a.equals(b) for a, b in zip(load_tax_tables(source, snapshot), df))
+            assert os.path.getmtime(snapshot) == recent
+            # an expired one is refreshed from the source...
+            old = time.time() - 2 * SNAPSHOT_TTL
+            os.utime(snapshot, (old, old))
+            load_tax_tables(source, snapshot)
+            assert os.path.getmtime(snapshot) > old
+            # ...unless the source fails, when it is used as it is
+            os.utime(snapshot, (old, old))
+            assert all(a.equals(b) for a, b in zip(load_tax_tables(missing, snapshot), df))
+            assert os.path.getmtime(snapshot) == old
+            try:
+                load_tax_tables(missing, os.path.join(path, 'none.pkl'))
+            except Exception:
+                pass
+            else:
+                raise AssertionError('loaded tax tables without a source or a snapshot')
+        prices = np.array([50000, 125000, 200000, 350000, 1250000], dtype=float)
+        bills = town_tax_bills(prices, df=df)
+        assert list(bills.index) == list(towns)
+        for town, location in towns.items():
+            expected = [_scan_tax_bill(df, location, price) for price in prices]
+            assert np.allclose(bills.loc[town].values, expected), town
+            assert np.allclose(loan_tax_bills(prices, [town] * len(prices), df), expected), town
+            assert np.allclose(get_town_tax_rate(town, prices), np.array(expected) / prices), town
+        assert np.isnan(loan_tax_bills([200000], ['Nowhere'], df)).all()
+    finally:
+        tax_dict, _TABLES, _INDEX = saved
+    print('taxes ok')
+
+if __name__ == '__main__':
+    test()